@@ -0,0 +1,62 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, TypeVar
+from sqlalchemy.orm import Session, sessionmaker
+from .db_service import save_artist, save_multiple_artists, update_artist_with_db, get_artist_by_id
+from .models import SessionLocal
+from .dtos import Artist as DtoArtist
+from .config import settings
+
+T = TypeVar("T")
+
+class AsyncDb:
+    """
+    The persistence layer for code on the event loop. SQLAlchemy here is synchronous, so every call is run on a small
+    dedicated thread pool instead of blocking the loop (and every other route search with it) while it waits on the
+    database.
+    Each call is one unit of work with its own session, committed (or rolled back) and closed in the worker thread,
+    so concurrent searches never share a session. The pool is kept no bigger than the engine's connection pool so
+    workers dont end up queueing for connections instead.
+    """
+
+    def __init__(self, session_factory: sessionmaker, max_workers: int):
+        self.session_factory = session_factory
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+
+    async def run(self, work: Callable[[Session], T]) -> T:
+        # If the awaiting search is cancelled the unit of work still finishes (or rolls back) in its thread
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._run_unit, work)
+
+    def _run_unit(self, work: Callable[[Session], T]) -> T:
+        db = self.session_factory()
+        try:
+            result = work(db)
+            db.commit()
+            return result
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def save_artist(self, artist: DtoArtist):
+        await self.run(lambda db: save_artist(db, artist))
+
+    async def save_multiple_artists(self, artists: List[DtoArtist]):
+        await self.run(lambda db: save_multiple_artists(db, artists))
+
+    async def update_artist_with_db(self, artist: DtoArtist, require_all_connections: bool = False) -> DtoArtist:
+        return await self.run(lambda db: update_artist_with_db(db, artist, require_all_connections=require_all_connections))
+
+    async def get_artist_by_id(self, artist_id: str, require_all_connections=False) -> DtoArtist:
+        return await self.run(lambda db: get_artist_by_id(db, artist_id, require_all_connections=require_all_connections))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+async_db = AsyncDb(SessionLocal, settings.db_workers)
+
+def get_async_db() -> AsyncDb:
+    # Dependency for the route endpoints, the handle opens a session per unit of work itself
+    return async_db
@@ -8,4 +8,67 @@ class Settings:
         else:
             self.api_base_url = "http://localhost:8000"
 
+        # Spotify HTTP connection pool, shared by every route search
+        self.spotify_max_connections = int(os.getenv("SPOTIFY_MAX_CONNECTIONS", "10"))
+        self.spotify_max_keepalive = int(os.getenv("SPOTIFY_MAX_KEEPALIVE", "10"))
+        self.spotify_keepalive_expiry = float(os.getenv("SPOTIFY_KEEPALIVE_EXPIRY", "30"))
+        self.spotify_timeout = float(os.getenv("SPOTIFY_TIMEOUT", "15"))
+
+        # Spotify rate limit (calls per rolling window) enforced by the shared token bucket
+        self.spotify_rate_limit = int(os.getenv("SPOTIFY_RATE_LIMIT", "90"))
+        self.spotify_rate_window = float(os.getenv("SPOTIFY_RATE_WINDOW", "30"))
+        self.spotify_rate_burst = int(os.getenv("SPOTIFY_RATE_BURST", "10"))
+
+        # Max album pages / detail batches in flight at once for a single crawl (they still queue on the rate limiter)
+        self.spotify_fetch_concurrency = int(os.getenv("SPOTIFY_FETCH_CONCURRENCY", "4"))
+
+        # Frontier artists whose connections are fetched in the background while the route search expands another, 0 disables
+        self.route_prefetch_count = int(os.getenv("ROUTE_PREFETCH_COUNT", "2"))
+
+        # ALT landmarks over the stored graph, used as A* lower bounds by the route search. 0 landmarks disables them
+        self.landmark_count = int(os.getenv("LANDMARK_COUNT", "16"))
+        self.landmark_refresh_interval = float(os.getenv("LANDMARK_REFRESH_INTERVAL", "60"))  # folding in newly saved connections
+        self.landmark_rebuild_interval = float(os.getenv("LANDMARK_REBUILD_INTERVAL", str(6 * 3600)))  # re-picking landmarks from scratch
+
+        # Artists one lookup in the stored graph may visit before giving up on it and searching live instead
+        self.cached_route_max_visited = int(os.getenv("CACHED_ROUTE_MAX_VISITED", "50000"))
+
+        # Recently found routes, served again without searching until they expire or an artist on them gets new connections
+        self.route_cache_size = int(os.getenv("ROUTE_CACHE_SIZE", "1000"))
+        self.route_cache_ttl = float(os.getenv("ROUTE_CACHE_TTL", str(6 * 3600)))
+        self.route_cache_store_graph = os.getenv("ROUTE_CACHE_STORE_GRAPH", "true").lower() == "true"  # graphs are much bigger than routes
+
+        # Seconds a client can be disconnected (e.g reconnecting) before its running route search is cancelled
+        self.ws_disconnect_grace = float(os.getenv("WS_DISCONNECT_GRACE", "10"))
+
+        # Default limits on a single route search (a request can ask for less), 0 means unlimited
+        self.route_max_seconds = float(os.getenv("ROUTE_MAX_SECONDS", "300"))
+        self.route_max_expansions = int(os.getenv("ROUTE_MAX_EXPANSIONS", "400"))
+        self.route_max_api_calls = int(os.getenv("ROUTE_MAX_API_CALLS", "3000"))
+
+        # Expansions a search asking for alternative routes gets per extra route, counted from when it finds its first one
+        self.route_alternative_expansions = int(os.getenv("ROUTE_ALTERNATIVE_EXPANSIONS", "5"))
+
+        # POST /routes/find/batch: pairs searched at once, and the limits shared by the whole batch (a request can ask for
+        # less), 0 means unlimited
+        self.batch_route_concurrency = int(os.getenv("BATCH_ROUTE_CONCURRENCY", "4"))
+        self.batch_route_max_seconds = float(os.getenv("BATCH_ROUTE_MAX_SECONDS", "1800"))
+        self.batch_route_max_expansions = int(os.getenv("BATCH_ROUTE_MAX_EXPANSIONS", "2000"))
+        self.batch_route_max_api_calls = int(os.getenv("BATCH_ROUTE_MAX_API_CALLS", "15000"))
+        self.batch_route_max_pairs = int(os.getenv("BATCH_ROUTE_MAX_PAIRS", "1000"))
+
+        # Threads running database work for the event loop (see async_db.py). Keep it at or under the engine's connection
+        # pool size (5 by default), more workers would only queue for connections
+        self.db_workers = int(os.getenv("DB_WORKERS", "5"))
+
+        # Local cache of spotify payloads. TTLs are in seconds per endpoint, 0 disables caching for that endpoint
+        self.response_cache_path = os.getenv("RESPONSE_CACHE_PATH", "spotify_cache.sqlite3")
+        self.response_cache_memory_size = int(os.getenv("RESPONSE_CACHE_MEMORY_SIZE", "20000"))
+        self.response_cache_disk_size = int(os.getenv("RESPONSE_CACHE_DISK_SIZE", "500000"))
+        self.response_cache_ttls = {
+            "albums": float(os.getenv("RESPONSE_CACHE_ALBUMS_TTL", str(30 * 24 * 3600))),  # tracklists basically never change
+            "artists": float(os.getenv("RESPONSE_CACHE_ARTISTS_TTL", str(24 * 3600))),  # popularity + followers drift
+            "artist_albums": float(os.getenv("RESPONSE_CACHE_ARTIST_ALBUMS_TTL", str(24 * 3600))),  # new releases
+        }
+
 settings = Settings()
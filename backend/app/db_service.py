@@ -1,94 +1,171 @@
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+from sqlalchemy import or_, case, func, select, update
+from sqlalchemy.dialects.postgresql import insert as postgres_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta
 import pytz
-from .models import Artist as DbArtist, Genre as DbGenre, Connection as DbConnection, SessionLocal
-from .dtos import Artist as DtoArtist
+from .models import Artist as DbArtist, Genre as DbGenre, Connection as DbConnection, SessionLocal, artist_genre_association, canonical_connection
+from .dtos import Artist as DtoArtist, MIXED_CRAWL_POLICY
+from .graph_index import graph_index
+from .genre_cache import genre_cache
 from fastapi import Depends
-from typing import List
-
-def save_artist(db: Session, artist: DtoArtist, previous_saves: List[str] = []):
-    # ensures all the genres exist before saving them.
-    # print(f"Saving {artist.name} to database")
-    is_full_artist = len(artist.connections) > 1
-    db_genre_list: List[DbGenre] = []
-    if artist.popularity != -1 and len(artist.genres) < 0 :
-        print(f"Detected that {artist.name} has genres to save")
-        db_genre_list = save_artist_genres(db, artist, artist.genres)
-    db_artist = db.query(DbArtist).filter(DbArtist.id == artist.id).first()
-    if db_artist: # updates existing version
-        db_artist.name = artist.name
-        db_artist.arturl = artist.artURL
-        db_artist.follower_count = artist.followers
-        db_artist.popularity = artist.popularity
-        db_artist.last_updated = artist.lastUpdated
-        db_artist.is_full_artist = is_full_artist
-        
-    if (not db_artist): # creates new entry
-        db_artist = DbArtist(
-        id=artist.id,
-        name=artist.name,
-        arturl=artist.artURL,
-        follower_count=artist.followers,
-        popularity=artist.popularity,
-        last_updated=artist.lastUpdated,
-        is_full_artist=is_full_artist,
-        genres=db_genre_list
-    )
-    db.add(db_artist)
-    db.commit()
-    db.refresh(db_artist)
-    previous_saves.append(artist.id)
-    for connection in artist.connections:
-        if connection.id not in previous_saves:
-            save_artist(db, connection, previous_saves) # uh oh recursion its getting serious. 
-    if len(artist.connections) > 1:       
-        save_artist_connections(db, artist, artist.connections) 
-        
-    return db_artist
-
-def save_artist_genres(db: Session, dto_artist: DtoArtist, genres: List[str]) -> List[DbGenre]:
-    db_genre_list: List[DbGenre] = []
-    for genre_name in genres:
-        db_genre = db.query(DbGenre).filter(DbGenre.name == genre_name).first()
-        if not db_genre:
-            db_genre = DbGenre(name=genre_name)
-            db.add(db_genre)
-            print(f"Added {db_genre.name} to database (id : {db_genre.id})")
-            db.commit()
-            db.refresh(db_genre)
-        
-        if db_genre not in db_genre_list:
-            db_genre_list.append(db_genre)
-    
-    db.commit()
-    return db_genre_list
+from typing import Dict, List, NamedTuple, Optional, Set
 
-def save_artist_connections(db: Session, dto_artist: DtoArtist, connections: List[DtoArtist]):
-    
-    # print(f"Saving connections for {dto_artist.name}")
-    for connection in connections:
-        # print(f"Checking Connection: {dto_artist.name} - {connection.name}")
-        db_connection = check_connection(db, dto_artist, connection)
-        if not db_connection:
-            db_connection = DbConnection(artist_id=dto_artist.id, related_artist_id=connection.id)
-            # print(f"Adding Connection: {dto_artist.name} - {connection.name}")
-            db.add(db_connection)
-            db.commit()
-            db.refresh(db_connection)
-                   
-def check_connection(db: Session, artist1: DtoArtist, artist2: DtoArtist) -> DbConnection:
-    return db.query(DbConnection).filter(
-        or_(
-            and_(DbConnection.artist_id == artist1.id, DbConnection.related_artist_id == artist2.id),
-            and_(DbConnection.artist_id == artist2.id, DbConnection.related_artist_id == artist1.id)
-        )
-    ).first()
+def upsert_insert(db: Session):
+    # INSERT ... ON CONFLICT needs the dialect's own insert(), postgres in production (sqlite for local testing)
+    return sqlite_insert if db.bind.dialect.name == "sqlite" else postgres_insert
+
+def chunked(rows: list, size: int = 1000):
+    # keeps multi-row statements under the drivers bound parameter limits
+    for index in range(0, len(rows), size):
+        yield rows[index:index+size]
+
+def save_artist(db: Session, artist: DtoArtist):
+    save_artists_bulk(db, [artist])
 
 def save_multiple_artists(db: Session, artists: List[DtoArtist]):
-    for artist in artists:
-        save_artist(db, artist)
-        
+    save_artists_bulk(db, artists)
+
+def save_artists_bulk(db: Session, artists: List[DtoArtist]):
+    # Saves the artists, every artist in their connections (all the way down) and the connections between them in one
+    # transaction, using multi-row INSERT ... ON CONFLICT upserts instead of a select / add / commit per row.
+    # An artist counts as fully crawled (is_full_artist) if it has more than one connection, same as before.
+    saved_artists: Dict[str, DtoArtist] = {}
+    connections: Dict[str, List[str]] = {}  # fully crawled artist id -> its related artist ids
+    stack = list(artists)
+    while stack:
+        artist = stack.pop()
+        connections_of_artist = artist.connections or []
+        is_full_artist = len(connections_of_artist) > 1
+        previous = saved_artists.get(artist.id)
+        # the same artist can turn up more than once (e.g as a connection of two others), keep whichever has real details
+        if previous is None or (previous.popularity == -1 and artist.popularity != -1):
+            saved_artists[artist.id] = artist
+        if is_full_artist and artist.id not in connections:
+            connections[artist.id] = [connection.id for connection in connections_of_artist]
+        if previous is None or is_full_artist:
+            stack.extend(connection for connection in connections_of_artist if connection.id not in saved_artists)
+    if not saved_artists:
+        return
+
+    genre_artists = [artist for artist in saved_artists.values() if artist.popularity != -1 and artist.genres]
+    # resolved before this transaction writes anything, new genres are committed separately by the genre cache
+    genre_ids = genre_cache.resolve(db, {genre_name for artist in genre_artists for genre_name in artist.genres})
+    try:
+        upsert_artist_rows(db, list(saved_artists.values()), set(connections))
+        insert_genre_links(db, genre_artists, genre_ids)
+        connection_diff = diff_connections(db, connections)
+        insert_connections(db, connection_diff.new_neighbours)
+        policy_labels = label_crawl_policies(db, {artist_id: saved_artists[artist_id].crawlPolicy for artist_id in connections}, connection_diff)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for artist in saved_artists.values():
+        graph_index.update_artist(artist, artist.id in connections)
+    for artist_id, related_artist_ids in connections.items():
+        graph_index.add_connections(artist_id, related_artist_ids)
+    for label in policy_labels:
+        graph_index.label_crawl_policy(label.artist_ids, label.policy, label.replace)
+
+def upsert_artist_rows(db: Session, artists: List[DtoArtist], full_artist_ids: Set[str]):
+    artists_table = DbArtist.__table__
+    rows = [{
+        "id": artist.id,
+        "name": artist.name,
+        "arturl": artist.artURL,
+        "follower_count": artist.followers,
+        "popularity": artist.popularity,
+        "last_updated": artist.lastUpdated,
+        "is_full_artist": artist.id in full_artist_ids,
+    } for artist in artists]
+    for chunk in chunked(rows):
+        statement = upsert_insert(db)(artists_table).values(chunk)
+        excluded = statement.excluded
+        # artists only known from a tracklist (popularity -1) dont overwrite details already fetched for them,
+        # and saving an artist without its connections doesnt undo an earlier crawl
+        def keep_fetched(column: str):
+            return case((excluded.popularity == -1, artists_table.c[column]), else_=excluded[column])
+        statement = statement.on_conflict_do_update(index_elements=[artists_table.c.id], set_={
+            "name": excluded.name,
+            "arturl": keep_fetched("arturl"),
+            "follower_count": keep_fetched("follower_count"),
+            "popularity": keep_fetched("popularity"),
+            "last_updated": func.coalesce(excluded.last_updated, artists_table.c.last_updated),
+            "is_full_artist": or_(func.coalesce(artists_table.c.is_full_artist, False), excluded.is_full_artist),
+        })  # crawl_policy is set by label_crawl_policies once the connections are in
+        db.execute(statement)
+
+def insert_genre_links(db: Session, artists: List[DtoArtist], genre_ids: Dict[str, int]):
+    links = [{"artist_id": artist.id, "genre_id": genre_ids[genre_name]} for artist in artists for genre_name in set(artist.genres)]
+    for chunk in chunked(links):
+        db.execute(upsert_insert(db)(artist_genre_association).values(chunk)
+                   .on_conflict_do_nothing(index_elements=[artist_genre_association.c.artist_id, artist_genre_association.c.genre_id]))
+
+class ConnectionDiff(NamedTuple):
+    new_neighbours: Dict[str, Set[str]]  # crawled artist id -> related artist ids it isnt connected to yet
+    exact_artist_ids: Set[str]  # crawled artists whose stored connections were all found again by this crawl
+
+def diff_connections(db: Session, connections: Dict[str, List[str]]) -> ConnectionDiff:
+    # connections maps an artist id to its related artist ids, each artists stored neighbours are fetched with one query
+    new_neighbours, exact_artist_ids = {}, set()
+    for artist_id, related_artist_ids in connections.items():
+        existing_neighbour_ids = get_neighbour_ids(db, artist_id)
+        related_artist_ids = set(related_artist_ids) - {artist_id}
+        new_neighbours[artist_id] = related_artist_ids - existing_neighbour_ids
+        if existing_neighbour_ids <= related_artist_ids:
+            exact_artist_ids.add(artist_id)
+    return ConnectionDiff(new_neighbours, exact_artist_ids)
+
+def insert_connections(db: Session, new_neighbours: Dict[str, Set[str]]):
+    # inserts the edges in canonical (smaller id first) order, skipping any another transaction got in first
+    rows = {}
+    for artist_id, related_artist_ids in new_neighbours.items():
+        for related_artist_id in related_artist_ids:
+            first_id, second_id = canonical_connection(artist_id, related_artist_id)
+            rows[(first_id, second_id)] = {"artist_id": first_id, "related_artist_id": second_id}
+    connections_table = DbConnection.__table__
+    for chunk in chunked(list(rows.values())):
+        db.execute(upsert_insert(db)(connections_table).values(chunk)
+                   .on_conflict_do_nothing(index_elements=[connections_table.c.artist_id, connections_table.c.related_artist_id]))
+
+class CrawlPolicyLabel(NamedTuple):
+    policy: str
+    artist_ids: Set[str]
+    replace: bool  # True sets the policy outright, False merges it with the one already stored
+
+def label_crawl_policies(db: Session, crawl_policies: Dict[str, Optional[str]], connection_diff: ConnectionDiff) -> List[CrawlPolicyLabel]:
+    # An artist's crawl_policy is the policy all of its stored connections were found under, which is what lets a crawl
+    # with that policy reuse them. Connections are only ever added, so a re-crawl under another policy can only take
+    # the label over if it found every stored connection again. Otherwise, and for the artists a crawl adds edges to,
+    # the label is merged: kept if it is the same policy (or unset), MIXED_CRAWL_POLICY if it isnt.
+    # crawl_policies maps each crawled artist to the policy its connections came from (None leaves labels alone).
+    replaced: Dict[str, Set[str]] = {}
+    merged: Dict[str, Set[str]] = {}
+    for artist_id, policy in crawl_policies.items():
+        if policy is None:
+            continue
+        (replaced if artist_id in connection_diff.exact_artist_ids else merged).setdefault(policy, set()).add(artist_id)
+        merged.setdefault(policy, set()).update(connection_diff.new_neighbours.get(artist_id, ()))
+    # replaced first, an artist crawled under one policy and given edges by a crawl under another ends up mixed
+    labels = [CrawlPolicyLabel(policy, artist_ids, True) for policy, artist_ids in replaced.items()] + \
+             [CrawlPolicyLabel(policy, artist_ids, False) for policy, artist_ids in merged.items() if artist_ids]
+    artists_table = DbArtist.__table__
+    stored_policy = artists_table.c.crawl_policy
+    for label in labels:
+        value = label.policy if label.replace else \
+            case((or_(stored_policy.is_(None), stored_policy == label.policy), label.policy), else_=MIXED_CRAWL_POLICY)
+        for chunk in chunked(sorted(label.artist_ids)):
+            db.execute(update(artists_table).where(artists_table.c.id.in_(chunk)).values(crawl_policy=value))
+    return labels
+
+def get_neighbour_ids(db: Session, artist_id: str) -> Set[str]:
+    # both directions of the canonical edges, each side served by its own index
+    rows = db.query(DbConnection.related_artist_id).filter(DbConnection.artist_id == artist_id).union_all(
+        db.query(DbConnection.artist_id).filter(DbConnection.related_artist_id == artist_id)).all()
+    return {neighbour_id for neighbour_id, in rows}
+
 def update_artist_with_db(db: Session, artist: DtoArtist, require_all_connections: bool = False) -> DtoArtist:
     print(f"Running update_artist_with_db for {artist.name}")
     dto_artist_from_db: DtoArtist = get_artist_by_id(db, artist.id, require_all_connections)
@@ -182,6 +259,7 @@ def combine_dto_artists(dto_artist_1: DtoArtist, dto_artist_2: DtoArtist, connec
             combined_connections.append(connection)
 
     combined_artist.connections = combined_connections
+    combined_artist.crawlPolicy = dto_artist_2.crawlPolicy or dto_artist_1.crawlPolicy
 
     # Combine genres without duplicates
     combined_artist.genres = list(set((dto_artist_1.genres or []) + (dto_artist_2.genres or [])))
@@ -196,90 +274,60 @@ def combine_dto_artists(dto_artist_1: DtoArtist, dto_artist_2: DtoArtist, connec
     return combined_artist
 
 
-def get_artist_by_id(db: Session, artist_id: str, require_all_connections=False) -> DtoArtist:
-    # Use joinedload to eagerly load genres and connections to keep them attached to the session.
-    db_artist = db.query(DbArtist).filter(DbArtist.id == artist_id).options(joinedload(DbArtist.genres), joinedload(DbArtist.connections)).first()
-    if require_all_connections and db_artist and len(db_artist.connections) < 1:
-        # to detect if the connections are extensive (main_artists connections have been explored and are not just the 3rd party ones (related_connections)) 
-        return None
-    if db_artist:
-        genres = [genre.name for genre in db_artist.genres]
-        print(f"database connections for {db_artist.name} : {len(db_artist.connections)} + {len(db_artist.related_connections)}. Length of Genres : {len(genres)}")
-        artist = DtoArtist(
-            id=db_artist.id,
-            artURL=db_artist.arturl,
-            followers=db_artist.follower_count,
-            name=db_artist.name,
-            popularity=db_artist.popularity,
-            lastUpdated=db_artist.last_updated,
-            genres=genres,
-            connections=get_artist_connections(db, db_artist)
-        )
-        return artist
-    return None
-
-def get_artist_connections(db: Session, artist: DbArtist) -> List[DtoArtist]:
-    connections: List[DbConnection] = db.query(DbConnection).filter(
-        (DbConnection.artist_id == artist.id) | 
-        (DbConnection.related_artist_id == artist.id)
-    ).options(joinedload(DbConnection.artist), joinedload(DbConnection.related_artist)).all() # added joinedLoad options to fix out of session issues with cached artists. 
- 
-    # Get all related artists
-    related_artists: List[DtoArtist] = convert_raw_connections_to_artists(artist, set(connections + artist.related_connections), requires_connections=True)
-    for artist in related_artists:
-        if artist.name == 'Taylor Swift':
-            print("ON SKIBIDI THIS SHIT WAS HERE WHY")
-
-    return related_artists
-
-def convert_raw_connections_to_artists(db_artist: DbArtist, raw_connections: list[DbConnection], excluded_ids : List[str] = [], requires_connections: bool = True) -> List[DtoArtist]:
-    
-    related_artists = []
-    if not requires_connections:
-        return []
-    print(f"converting raw connections for {db_artist.name}. raw connection count: {len(raw_connections)}. requires_connections={requires_connections}")
-    for connection in raw_connections:
-        related_artist = None
-        excluded_artist = None
-        if connection.related_artist_id in excluded_ids: # connection.artist_id in excluded_ids or --> may need to add back.
-            continue
-        if connection.artist_id == db_artist.id:
-            related_artist : DbArtist = connection.related_artist
-            # print(f"Connection Found: {db_artist.name} -> {related_artist.name}")
-            excluded_artist = related_artist
-        elif connection.related_artist_id == db_artist.id:
-            related_artist : DbArtist = connection.artist
-            print(f"Connection Found: {related_artist.name} -> {db_artist.name}")
-            # print(f"adding {related_artist} to excluded_ids")
-            excluded_artist = related_artist
-        if related_artist != None:
-            requires_connections = False
-            excluded_ids.append(excluded_artist.id)
-            excluded_ids = set(excluded_ids)
-            excluded_ids = list(excluded_ids)
-            # print(f"convert_raw_connections_to_artists | Appending {excluded_artist.name}'s id to excluded_ids.")
-            # print(f"excluded_ids.size = {len(excluded_ids)}")
-            dtoArtist : DtoArtist = db_artist_to_dto_artist(related_artist, excluded_ids, requires_connections=requires_connections)
-            related_artists.append(dtoArtist)
-            # print(f"{db_artist.name}'s related_artists = [{', '.join([artist.name for artist in related_artists])}]")
-    return related_artists
-
-def db_artist_to_dto_artist(db_artist: DbArtist, excluded_artists: List[str] = [], requires_connections: bool = True) -> DtoArtist:
-    
-    # if artist.is_full_artist:
-    #     db_genre_list = save_artist_genres(get_db(), artist, artist.genres)
-    # removed above logic as i believe the genreList should be attached to the artist already (untested)
+class ArtistNeighbourhood(NamedTuple):
+    # An artist and its one-hop neighbours, flat: nobody's connections are filled in, the neighbours are referenced by id.
+    artist: DtoArtist
+    neighbour_ids: List[str]
+    neighbours: Dict[str, DtoArtist]
+
+    def to_artist(self) -> DtoArtist:
+        # the artist with its neighbours as connections (one level deep), as the route search uses it
+        return self.artist.model_copy(update={"connections": [self.neighbours[neighbour_id] for neighbour_id in self.neighbour_ids]})
+
+ARTIST_COLUMNS = (DbArtist.id, DbArtist.name, DbArtist.arturl, DbArtist.follower_count, DbArtist.popularity,
+                  DbArtist.last_updated, DbArtist.crawl_policy, DbArtist.is_full_artist)
+
+def artist_row_to_dto(row, genres: List[str]) -> DtoArtist:
     return DtoArtist(
-        id=db_artist.id,
-        artURL=db_artist.arturl,
-        followers=db_artist.follower_count,
-        name=db_artist.name,
-        popularity=db_artist.popularity,
-        lastUpdated=db_artist.last_updated,
-        genres=[genre.name for genre in db_artist.genres], # db_artist.genres, -> used to be this but was erroring.
-        connections=convert_raw_connections_to_artists(db_artist, db_artist.connections, excluded_artists, requires_connections=requires_connections)
+        id=row.id,
+        artURL=row.arturl,
+        followers=row.follower_count,
+        name=row.name,
+        popularity=row.popularity,
+        lastUpdated=row.last_updated,
+        genres=genres,
+        crawlPolicy=row.crawl_policy,
+        connections=[]
     )
 
+def load_neighbourhood(db: Session, artist_id: str, require_full_artist=False) -> Optional[ArtistNeighbourhood]:
+    # Three queries however many neighbours there are: the artist, its neighbours (through both columns of the
+    # canonical connections) and the genres of all of them. require_full_artist returns None (after the first query)
+    # for artists whose own connections havent been crawled.
+    artist_row = db.query(*ARTIST_COLUMNS).filter(DbArtist.id == artist_id).first()
+    if artist_row is None or (require_full_artist and not artist_row.is_full_artist):
+        return None
+    neighbour_ids = db.query(DbConnection.related_artist_id.label("neighbour_id")).filter(DbConnection.artist_id == artist_id).union_all(
+        db.query(DbConnection.artist_id).filter(DbConnection.related_artist_id == artist_id)).subquery()
+    neighbour_rows = db.query(*ARTIST_COLUMNS).filter(DbArtist.id.in_(select(neighbour_ids.c.neighbour_id))).all()
+    genre_rows = db.query(artist_genre_association.c.artist_id, DbGenre.name).join(
+        DbGenre, DbGenre.id == artist_genre_association.c.genre_id).filter(or_(
+            artist_genre_association.c.artist_id == artist_id,
+            artist_genre_association.c.artist_id.in_(select(neighbour_ids.c.neighbour_id)))).all()
+
+    genres_by_artist: Dict[str, List[str]] = {}
+    for genre_artist_id, genre_name in genre_rows:
+        genres_by_artist.setdefault(genre_artist_id, []).append(genre_name)
+    neighbours = {row.id: artist_row_to_dto(row, genres_by_artist.get(row.id, [])) for row in neighbour_rows}
+    print(f"database connections for {artist_row.name} : {len(neighbours)}. Length of Genres : {len(genres_by_artist.get(artist_id, []))}")
+    return ArtistNeighbourhood(artist_row_to_dto(artist_row, genres_by_artist.get(artist_id, [])), list(neighbours), neighbours)
+
+def get_artist_by_id(db: Session, artist_id: str, require_all_connections=False) -> DtoArtist:
+    # require_all_connections only returns artists whose own connections have been crawled, not ones just seen as
+    # someone elses connection
+    neighbourhood = load_neighbourhood(db, artist_id, require_full_artist=require_all_connections)
+    return neighbourhood.to_artist() if neighbourhood is not None else None
+
 # Dependency to get DB session
 def get_db():
     db = SessionLocal()
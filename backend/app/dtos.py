@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Set
+from typing import List, Optional, Dict, Set, Tuple
 from datetime import datetime
 import copy
 
@@ -33,6 +33,10 @@ class ReducedArtists(BaseModel):
 class ArtistSearchResponse(BaseModel):
     artists: ReducedArtists
 
+# Compact form of a track's artists used by connection crawls: ((artist_id, artist_name), ...)
+TrackArtistRef = Tuple[str, str]
+TrackArtists = Tuple[TrackArtistRef, ...]
+
 class TrackArtist(BaseModel):
     external_urls: Dict[str, str]
     href: str
@@ -41,6 +45,31 @@ class TrackArtist(BaseModel):
     type: str
     uri: str
 
+VARIOUS_ARTISTS_ID = "0LyfQWJT6nXafLPZqxe9Of"  # spotify's "Various Artists" placeholder artist
+
+class CrawlPolicy(BaseModel):
+    # Controls which albums / tracks count as collaborations when crawling an artist's connections.
+    include_groups: str = "single,appears_on,album"
+    skip_compilations: bool = True  # compilation albums and anything credited to "Various Artists"
+    max_artists_per_album: Optional[int] = 25  # collaborators taken from a single album, None for no cap
+    credited_tracks_only: bool = True  # only tracks the crawled artist is credited on, otherwise every track on the album
+
+    def key(self) -> str:
+        # stored alongside cached connections, so they are only reused by crawls with the same policy
+        return (f"groups={self.include_groups};compilations={'skip' if self.skip_compilations else 'keep'};"
+                f"max_per_album={self.max_artists_per_album};credited={int(self.credited_tracks_only)}")
+
+    def accepts_album(self, album_item: dict) -> bool:
+        # album_item is a simplified album from /artists/{id}/albums
+        if not self.skip_compilations:
+            return True
+        if album_item.get('album_type') == 'compilation':
+            return False
+        return not any(album_artist.get('id') == VARIOUS_ARTISTS_ID for album_artist in album_item.get('artists', []))
+
+DEFAULT_CRAWL_POLICY = CrawlPolicy()
+MIXED_CRAWL_POLICY = "mixed"  # stored for artists whose connections were found under different policies, never reused
+
 class Artist(BaseModel):
     id: str
     artURL: str
@@ -50,6 +79,7 @@ class Artist(BaseModel):
     lastUpdated: Optional[datetime]
     connections: Optional[List['Artist']]  # Use a forward reference
     genres: Optional[List[str]] = []
+    crawlPolicy: Optional[str] = None  # CrawlPolicy.key() the connections were crawled with (see label_crawl_policies)
     
     def __str__(self):
         print(self.connections)
@@ -92,6 +122,19 @@ class Artist(BaseModel):
             genres=[]
         )
         
+    @classmethod
+    def from_track_artist_ref(cls, artist_id: str, artist_name: str):
+        return cls(
+            id=artist_id,
+            artURL="",
+            followers=-1,
+            name=artist_name,
+            popularity=-1,
+            lastUpdated=None,
+            connections=[],
+            genres=[]
+        )
+        
     def without_connections(self, **kwargs: any) -> dict:
         instance = self
         instance.connections = None
@@ -115,7 +158,7 @@ class Track(BaseModel):
     href: str
     id: str
     name: str
-    preview_url: Optional[str]
+    preview_url: Optional[str] = None  # spotify has started leaving this out entirely
     track_number: int
     uri: str
     duration_ms: int
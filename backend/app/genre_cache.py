@@ -0,0 +1,53 @@
+import threading
+from typing import Dict, Iterable
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as postgres_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from .models import Genre as DbGenre
+
+class GenreCache:
+    """
+    Process-wide genre name -> id map, loaded once at startup (the genre vocabulary is small and barely changes) so
+    genre links can be written without looking genres up.
+    Unknown genres are inserted in bulk in their own short transaction, so an id only gets cached once its row is
+    committed and a rolled back save cant leave ids behind that dont exist. Inserts are serialised by a lock,
+    lookups of known genres never wait on it.
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.insert_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def load(self, db: Session):
+        self.ids = dict(db.query(DbGenre.name, DbGenre.id).all())
+        print(f"Genre cache loaded: {len(self.ids)} genres")
+
+    def resolve(self, db: Session, genre_names: Iterable[str]) -> Dict[str, int]:
+        genre_names = set(genre_names)
+        if any(genre_name not in self.ids for genre_name in genre_names):
+            with self.insert_lock:
+                missing = sorted(genre_name for genre_name in genre_names if genre_name not in self.ids)
+                if missing:
+                    self._insert(db, missing)
+        return {genre_name: self.ids[genre_name] for genre_name in genre_names}
+
+    def _insert(self, db: Session, genre_names: list):
+        engine = db.get_bind()
+        insert = sqlite_insert if engine.dialect.name == "sqlite" else postgres_insert
+        genres_table = DbGenre.__table__
+        found = {}
+        with engine.begin() as connection:
+            for index in range(0, len(genre_names), 1000):
+                chunk = genre_names[index:index+1000]
+                connection.execute(insert(genres_table).values([{"name": genre_name} for genre_name in chunk])
+                                   .on_conflict_do_nothing(index_elements=[genres_table.c.name]))
+                # selected rather than RETURNING, genres another process added in the meantime arent returned by DO NOTHING
+                found.update(connection.execute(select(genres_table.c.name, genres_table.c.id).where(genres_table.c.name.in_(chunk))).all())
+        self.ids.update(found)
+        print(f"Added {len(genre_names)} genres to database")
+
+genre_cache = GenreCache()
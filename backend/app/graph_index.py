@@ -0,0 +1,327 @@
+import threading
+from array import array
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy.orm import Session
+from .models import Artist as DbArtist, Genre as DbGenre, Connection as DbConnection, artist_genre_association
+from .dtos import Artist as DtoArtist, MIXED_CRAWL_POLICY
+
+class GraphIndex:
+    """
+    Process-wide, in-memory copy of the stored collaboration graph so cached connections can be answered without
+    touching the database.
+    Artist ids are interned to integers; edges loaded at startup live in CSR form (offsets + neighbours arrays) and
+    edges saved afterwards go into a small per-artist overlay, folded back into the CSR arrays by compact().
+    """
+
+    def __init__(self, compact_threshold: int = 50000):
+        self.lock = threading.RLock()
+        self.compact_threshold = compact_threshold
+        self.generation = 0
+        self.edge_listeners: List[Callable[[List[Tuple[int, int]]], None]] = []  # told about every edge add_connections stores
+        self._reset()
+
+    def _reset(self):
+        self.artist_numbers: Dict[str, int] = {}  # spotify id -> interned number
+        self.artist_ids: List[str] = []  # interned number -> spotify id
+        # per artist metadata, indexed by interned number
+        self.names: List[str] = []
+        self.art_urls: List[str] = []
+        self.followers = array('q')
+        self.popularity = array('i')
+        self.genres: List[Tuple[str, ...]] = []
+        self.last_updated: List[Optional[datetime]] = []
+        self.crawl_policies: List[Optional[str]] = []
+        self.full_artists = bytearray()  # 1 if the artists own connections have been crawled (is_full_artist)
+        # edges
+        self.offsets = array('l', [0])
+        self.neighbour_numbers = array('l')
+        self.added_edges: Dict[int, Set[int]] = {}
+        self.added_edge_count = 0
+        self.compacting = False
+        self.compacting_edges: Dict[int, Set[int]] = {}  # the overlay compact() is folding in
+        self.loaded = False
+        self.generation += 1  # interned numbers are only meaningful within one generation
+
+    def __len__(self) -> int:
+        return len(self.artist_ids)
+
+    def intern(self, artist_id: str) -> int:
+        with self.lock:
+            number = self.artist_numbers.get(artist_id)
+            if number is None:
+                number = len(self.artist_ids)
+                self.artist_numbers[artist_id] = number
+                self.artist_ids.append(artist_id)
+                self.names.append("")
+                self.art_urls.append("")
+                self.followers.append(-1)
+                self.popularity.append(-1)
+                self.genres.append(())
+                self.last_updated.append(None)
+                self.crawl_policies.append(None)
+                self.full_artists.append(0)
+            return number
+
+    def load(self, db: Session):
+        # builds the whole index from the artists / artist_genre / connections tables
+        artist_rows = db.query(DbArtist.id, DbArtist.name, DbArtist.arturl, DbArtist.follower_count, DbArtist.popularity,
+                               DbArtist.last_updated, DbArtist.crawl_policy, DbArtist.is_full_artist).all()
+        genre_rows = db.query(artist_genre_association.c.artist_id, DbGenre.name).join(
+            DbGenre, DbGenre.id == artist_genre_association.c.genre_id).all()
+        edge_rows = db.query(DbConnection.artist_id, DbConnection.related_artist_id).all()
+
+        with self.lock:
+            self._reset()
+            for artist_id, name, art_url, follower_count, popularity, last_updated, crawl_policy, is_full_artist in artist_rows:
+                number = self.intern(artist_id)
+                self.names[number] = name
+                self.art_urls[number] = art_url or ""
+                self.followers[number] = follower_count if follower_count is not None else -1
+                self.popularity[number] = popularity if popularity is not None else -1
+                self.last_updated[number] = last_updated
+                self.crawl_policies[number] = crawl_policy
+                self.full_artists[number] = 1 if is_full_artist else 0
+            genre_lists: Dict[int, List[str]] = {}
+            for artist_id, genre_name in genre_rows:
+                genre_lists.setdefault(self.intern(artist_id), []).append(genre_name)
+            for number, genre_names in genre_lists.items():
+                self.genres[number] = tuple(genre_names)
+            self._build_csr([(self.intern(artist_id), self.intern(related_id)) for artist_id, related_id in edge_rows])
+            self.loaded = True
+        print(f"Graph index loaded: {len(self.artist_ids)} artists, {len(self.neighbour_numbers) // 2} connections")
+
+    def _build_csr(self, edges: Iterable[Tuple[int, int]]):
+        # edges are undirected, each one is stored under both of its artists
+        adjacency: List[Set[int]] = [set() for _ in range(len(self.artist_ids))]
+        for artist_number, related_number in edges:
+            if artist_number != related_number:
+                adjacency[artist_number].add(related_number)
+                adjacency[related_number].add(artist_number)
+        offsets = array('l', [0])
+        neighbour_numbers = array('l')
+        for neighbours in adjacency:
+            neighbour_numbers.extend(sorted(neighbours))
+            offsets.append(len(neighbour_numbers))
+        self.offsets = offsets
+        self.neighbour_numbers = neighbour_numbers
+        self.added_edges = {}
+        self.added_edge_count = 0
+
+    def compact(self):
+        # Folds the overlay back into the CSR arrays. Rebuilding takes seconds on a big graph so it isnt done under
+        # the lock: the overlay is set aside as compacting_edges (still read by lookups, new edges go into a fresh
+        # overlay) and only swapping the finished arrays in happens under it.
+        with self.lock:
+            if self.compacting:
+                return
+            self.compacting = True
+            self.compacting_edges = self.added_edges
+            self.added_edges = {}
+            self.added_edge_count = 0
+            node_count, offsets, neighbour_numbers, overlay, generation = \
+                len(self.artist_ids), self.offsets, self.neighbour_numbers, self.compacting_edges, self.generation
+        try:
+            # the arrays are only ever replaced, never changed in place, and the set aside overlay isnt changed either
+            new_offsets, new_neighbour_numbers = self._merge_csr(node_count, offsets, neighbour_numbers, overlay)
+            with self.lock:
+                if self.generation == generation:  # otherwise reloaded meanwhile, the new arrays are already compact
+                    self.offsets = new_offsets
+                    self.neighbour_numbers = new_neighbour_numbers
+                    self.compacting_edges = {}
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    @staticmethod
+    def _merge_csr(node_count: int, offsets: array, neighbour_numbers: array, overlay: Dict[int, Set[int]]) -> Tuple[array, array]:
+        # CSR arrays for the first node_count artists with the overlay merged in
+        csr_size = len(offsets) - 1
+        new_offsets = array('l', [0])
+        new_neighbour_numbers = array('l')
+        for number in range(node_count):
+            start, end = (offsets[number], offsets[number + 1]) if number < csr_size else (0, 0)
+            extra = overlay.get(number)
+            if extra:
+                new_neighbour_numbers.extend(sorted(extra.union(neighbour_numbers[start:end])))
+            else:
+                new_neighbour_numbers.extend(neighbour_numbers[start:end])
+            new_offsets.append(len(new_neighbour_numbers))
+        return new_offsets, new_neighbour_numbers
+
+    def adjacency_snapshot(self) -> Tuple[int, array, array, Dict[int, Set[int]], int]:
+        # (artist count, offsets, neighbours, overlay, generation) copied under the lock,
+        # so a background job can walk the graph without holding it
+        with self.lock:
+            overlay = {number: set(neighbours) for number, neighbours in self.compacting_edges.items()}
+            for number, neighbours in self.added_edges.items():
+                overlay.setdefault(number, set()).update(neighbours)
+            return len(self.artist_ids), array('l', self.offsets), array('l', self.neighbour_numbers), overlay, self.generation
+
+    def _neighbour_numbers(self, number: int) -> Set[int]:
+        neighbours = set()
+        if number + 1 < len(self.offsets):
+            neighbours.update(self.neighbour_numbers[self.offsets[number]:self.offsets[number + 1]])
+        neighbours.update(self.compacting_edges.get(number, ()))
+        neighbours.update(self.added_edges.get(number, ()))
+        return neighbours
+
+    def neighbour_ids(self, artist_id: str) -> List[str]:
+        with self.lock:
+            number = self.artist_numbers.get(artist_id)
+            if number is None:
+                return []
+            return [self.artist_ids[neighbour] for neighbour in self._neighbour_numbers(number)]
+
+    def degree(self, artist_id: str) -> int:
+        return len(self.neighbour_ids(artist_id))
+
+    def is_full_artist(self, artist_id: str) -> bool:
+        number = self.artist_numbers.get(artist_id)
+        return number is not None and self.full_artists[number] == 1
+
+    def update_artist(self, artist: DtoArtist, is_full_artist: bool):
+        # mirrors the upsert in save_artists_bulk, so the index and the artists table agree
+        with self.lock:
+            number = self.intern(artist.id)
+            self.names[number] = artist.name
+            if artist.popularity != -1 or self.popularity[number] == -1:  # tracklist-only artists dont overwrite fetched details
+                self.art_urls[number] = artist.artURL or ""
+                self.followers[number] = artist.followers
+                self.popularity[number] = artist.popularity
+            if artist.genres:
+                self.genres[number] = tuple(artist.genres)
+            if artist.lastUpdated is not None:
+                self.last_updated[number] = artist.lastUpdated
+            if is_full_artist:
+                self.full_artists[number] = 1
+
+    def label_crawl_policy(self, artist_ids: Iterable[str], policy: str, replace: bool):
+        # mirrors label_crawl_policies in db_service
+        with self.lock:
+            for artist_id in artist_ids:
+                number = self.intern(artist_id)
+                stored_policy = self.crawl_policies[number]
+                if replace or stored_policy is None or stored_policy == policy:
+                    self.crawl_policies[number] = policy
+                else:
+                    self.crawl_policies[number] = MIXED_CRAWL_POLICY
+
+    def add_connections(self, artist_id: str, related_artist_ids: Iterable[str]):
+        new_edges = []
+        with self.lock:
+            number = self.intern(artist_id)
+            existing_neighbours = self._neighbour_numbers(number)
+            for related_id in related_artist_ids:
+                related_number = self.intern(related_id)
+                if related_number == number or related_number in existing_neighbours:
+                    continue
+                existing_neighbours.add(related_number)
+                self.added_edges.setdefault(number, set()).add(related_number)
+                self.added_edges.setdefault(related_number, set()).add(number)
+                self.added_edge_count += 1
+                new_edges.append((number, related_number))
+            needs_compacting = self.added_edge_count > self.compact_threshold and not self.compacting
+        if needs_compacting:
+            # in its own thread, the db worker saving these connections shouldnt wait on the rebuild
+            threading.Thread(target=self.compact, name="graph-index-compact", daemon=True).start()
+        if new_edges:
+            for listener in self.edge_listeners:
+                listener(new_edges)
+
+    def get_artist(self, artist_id: str) -> Optional[DtoArtist]:
+        with self.lock:
+            number = self.artist_numbers.get(artist_id)
+            if number is None:
+                return None
+            return self._to_dto(number)
+
+    def _to_dto(self, number: int) -> DtoArtist:
+        # model_construct skips validation, the index only ever holds values that came from a valid Artist / db row
+        return DtoArtist.model_construct(
+            id=self.artist_ids[number],
+            artURL=self.art_urls[number],
+            followers=self.followers[number],
+            name=self.names[number],
+            popularity=self.popularity[number],
+            lastUpdated=self.last_updated[number],
+            connections=[],
+            genres=list(self.genres[number]),
+            crawlPolicy=self.crawl_policies[number]
+        )
+
+    def get_cached_connections(self, artist_id: str) -> Optional[Tuple[List[DtoArtist], Optional[str]]]:
+        # (connections, crawl policy they came from) for fully crawled artists, None when the artist needs crawling
+        with self.lock:
+            number = self.artist_numbers.get(artist_id)
+            if number is None or not self.full_artists[number]:
+                return None
+            connections = [self._to_dto(neighbour) for neighbour in self._neighbour_numbers(number)]
+            return connections, self.crawl_policies[number]
+
+    def find_path(self, start_id: str, end_id: str, max_depth: int = 8, full_artists_only: bool = True, max_visited: int = None) -> Optional[List[str]]:
+        # Bidirectional BFS over the stored graph, returning the artist ids of a shortest path (or None).
+        # With full_artists_only only fully crawled artists are expanded, any stored edge is still a real collaboration
+        # so partially crawled artists can sit on the path, they just arent searched from. The two end points are
+        # always expanded from whatever edges are stored for them.
+        # The lock is only taken per artist read, so a long lookup (run it off the event loop) doesnt stall the index,
+        # and max_visited caps how many artists one lookup can touch.
+        with self.lock:
+            start = self.artist_numbers.get(start_id)
+            end = self.artist_numbers.get(end_id)
+            generation = self.generation
+        if start is None or end is None:
+            return None
+        if start == end:
+            return [start_id]
+        forward_parents: Dict[int, int] = {start: -1}
+        backward_parents: Dict[int, int] = {end: -1}
+        forward_frontier, backward_frontier = [start], [end]
+
+        for _ in range(max_depth):
+            if not forward_frontier or not backward_frontier:
+                return None  # one side has run out of artists to expand, so nothing stored joins them
+            expand_forward = len(forward_frontier) <= len(backward_frontier)
+            frontier, own_parents, other_parents = (forward_frontier, forward_parents, backward_parents) if expand_forward \
+                else (backward_frontier, backward_parents, forward_parents)
+            next_frontier = []
+            for number in frontier:
+                with self.lock:
+                    if self.generation != generation:
+                        return None  # reloaded, the interned numbers mean something else now
+                    if full_artists_only and not self.full_artists[number] and number != start and number != end:
+                        continue
+                    neighbours = self._neighbour_numbers(number)
+                for neighbour in neighbours:
+                    if neighbour in own_parents:
+                        continue
+                    own_parents[neighbour] = number
+                    if neighbour in other_parents:
+                        with self.lock:
+                            if self.generation != generation:
+                                return None
+                            return self._join_bfs_paths(neighbour, forward_parents, backward_parents)
+                    next_frontier.append(neighbour)
+                if max_visited and len(forward_parents) + len(backward_parents) > max_visited:
+                    print(f"Cached route lookup gave up after visiting {max_visited} artists")
+                    return None
+            if expand_forward:
+                forward_frontier = next_frontier
+            else:
+                backward_frontier = next_frontier
+        return None
+
+    def _join_bfs_paths(self, meeting: int, forward_parents: Dict[int, int], backward_parents: Dict[int, int]) -> List[str]:
+        path = []
+        number = meeting
+        while number != -1:
+            path.append(number)
+            number = forward_parents[number]
+        path.reverse()
+        number = backward_parents[meeting]
+        while number != -1:
+            path.append(number)
+            number = backward_parents[number]
+        return [self.artist_ids[number] for number in path]
+
+graph_index = GraphIndex()
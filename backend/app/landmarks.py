@@ -0,0 +1,162 @@
+import time
+import asyncio
+import threading
+from array import array
+from collections import deque
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from .graph_index import GraphIndex, graph_index
+from .config import settings
+
+UNREACHED = 0xFFFF  # distances are stored as unsigned shorts, no route in the stored graph is anywhere near this long
+
+class LandmarkTable:
+    """
+    ALT (A*, Landmarks, Triangle inequality) distance tables over the stored graph.
+    A handful of well connected hub artists are picked as landmarks and a BFS from each stores its distance to every
+    artist. For any two artists a and b, |d(L, a) - d(L, b)| <= d(a, b) for every landmark L, which gives the route
+    search a lower bound on how far an artist still is from its target.
+    The bounds hold for the stored graph, a newly crawled edge can only make real routes shorter, so the tables are
+    relaxed incrementally as connections are saved (apply_pending) and rebuilt from scratch now and then (rebuild).
+    """
+
+    def __init__(self, landmark_count: int):
+        self.landmark_count = landmark_count
+        self.landmark_numbers: List[int] = []
+        self.distances: List[array] = []  # one per landmark, indexed by graph index number
+        self.generation = -1  # graph index generation the numbers above belong to
+        self.pending_edges: List[Tuple[int, int]] = []
+        self.pending_lock = threading.Lock()
+
+    def is_built(self) -> bool:
+        return bool(self.landmark_numbers)
+
+    def queue_edges(self, edges: List[Tuple[int, int]]):
+        # GraphIndex edge listener, called from whichever db worker saved the edges so it only records them
+        with self.pending_lock:
+            self.pending_edges.extend(edges)
+
+    def has_pending(self) -> bool:
+        return bool(self.pending_edges)
+
+    def _take_pending(self) -> List[Tuple[int, int]]:
+        with self.pending_lock:
+            edges, self.pending_edges = self.pending_edges, []
+        return edges
+
+    def rebuild(self, index: GraphIndex):
+        # picks landmarks and runs a full BFS from each, meant to be run in a worker thread
+        started = time.perf_counter()
+        self._take_pending()  # the snapshot below already has them
+        node_count, offsets, neighbour_numbers, overlay, generation = index.adjacency_snapshot()
+        neighbours_of = self._neighbour_lookup(offsets, neighbour_numbers, overlay)
+
+        # highest degree first, skipping artists right next to a landmark already chosen so they dont all give the same bound
+        candidates = sorted(range(node_count), key=lambda number: len(neighbours_of(number)), reverse=True)
+        landmark_numbers, distances = [], []
+        for number in candidates:
+            if len(landmark_numbers) >= self.landmark_count or not neighbours_of(number):
+                break
+            if any(landmark_distances[number] <= 1 for landmark_distances in distances):
+                continue
+            landmark_numbers.append(number)
+            distances.append(self._bfs(number, node_count, neighbours_of))
+
+        self.landmark_numbers, self.distances, self.generation = landmark_numbers, distances, generation
+        print(f"Landmarks rebuilt: {len(landmark_numbers)} landmarks over {node_count} artists in {time.perf_counter() - started:.2f}s")
+
+    def apply_pending(self, index: GraphIndex):
+        # Adding an edge can only shorten distances, so each landmark's table is relaxed outwards from the new edges
+        # instead of redoing the whole BFS.
+        edges = self._take_pending()
+        if not edges or not self.is_built():
+            return
+        node_count, offsets, neighbour_numbers, overlay, generation = index.adjacency_snapshot()
+        if generation != self.generation:
+            return  # index was reloaded, the next rebuild picks everything up
+        neighbours_of = self._neighbour_lookup(offsets, neighbour_numbers, overlay)
+        updated = []
+        for landmark_distances in self.distances:
+            landmark_distances = array('H', landmark_distances)  # copy, searches may be reading the current one
+            if len(landmark_distances) < node_count:
+                landmark_distances.extend([UNREACHED] * (node_count - len(landmark_distances)))
+            queue = deque()
+            for artist_number, related_number in edges:
+                for near, far in ((artist_number, related_number), (related_number, artist_number)):
+                    if landmark_distances[near] != UNREACHED and landmark_distances[near] + 1 < landmark_distances[far]:
+                        landmark_distances[far] = landmark_distances[near] + 1
+                        queue.append(far)
+            self._propagate(landmark_distances, queue, neighbours_of)
+            updated.append(landmark_distances)
+        self.distances = updated
+
+    def _neighbour_lookup(self, offsets: array, neighbour_numbers: array, overlay: Dict[int, Set[int]]) -> Callable[[int], List[int]]:
+        csr_size = len(offsets) - 1
+        def neighbours_of(number: int) -> List[int]:
+            neighbours = list(neighbour_numbers[offsets[number]:offsets[number + 1]]) if number < csr_size else []
+            extra = overlay.get(number)
+            if extra:
+                neighbours.extend(extra)
+            return neighbours
+        return neighbours_of
+
+    def _bfs(self, source: int, node_count: int, neighbours_of: Callable[[int], List[int]]) -> array:
+        landmark_distances = array('H', [UNREACHED]) * node_count
+        landmark_distances[source] = 0
+        self._propagate(landmark_distances, deque([source]), neighbours_of)
+        return landmark_distances
+
+    def _propagate(self, landmark_distances: array, queue: deque, neighbours_of: Callable[[int], List[int]]):
+        while queue:
+            number = queue.popleft()
+            next_distance = landmark_distances[number] + 1
+            for neighbour in neighbours_of(number):
+                if next_distance < landmark_distances[neighbour]:
+                    landmark_distances[neighbour] = next_distance
+                    queue.append(neighbour)
+
+    def heuristic_to(self, index: GraphIndex, target_id: str) -> Optional[Callable[[str], int]]:
+        # A lower bound on the number of hops from any artist to the target, or None if the tables know nothing about
+        # the target (not stored yet, or not reachable from any landmark) in which case the search shouldnt use it.
+        target_number = index.artist_numbers.get(target_id)
+        if target_number is None or self.generation != index.generation:
+            return None
+        target_distances = [(landmark_distances, landmark_distances[target_number]) for landmark_distances in self.distances
+                            if target_number < len(landmark_distances) and landmark_distances[target_number] != UNREACHED]
+        if not target_distances:
+            return None
+        artist_numbers = index.artist_numbers
+
+        def lower_bound(artist_id: str) -> int:
+            number = artist_numbers.get(artist_id)
+            if number is None:
+                return 0  # never stored, nothing known so the only safe bound is 0
+            bound = 0
+            for landmark_distances, target_distance in target_distances:
+                if number < len(landmark_distances):
+                    distance = landmark_distances[number]
+                    if distance != UNREACHED and abs(distance - target_distance) > bound:
+                        bound = abs(distance - target_distance)
+            return bound
+        return lower_bound
+
+
+async def run_landmark_job(table: LandmarkTable, index: GraphIndex, refresh_interval: float, rebuild_interval: float):
+    # Background job, started with the app. Relaxes the tables with newly saved connections every refresh_interval
+    # and rebuilds them (landmarks can drift as the graph grows) every rebuild_interval, both off the event loop.
+    if table.landmark_count <= 0:
+        return
+    last_rebuild = None
+    while True:
+        try:
+            if last_rebuild is None or time.monotonic() - last_rebuild > rebuild_interval or (not table.is_built() and table.has_pending()):
+                await asyncio.to_thread(table.rebuild, index)
+                last_rebuild = time.monotonic()
+            elif table.has_pending():
+                await asyncio.to_thread(table.apply_pending, index)
+        except Exception as e:
+            print(f"Landmark job failed: {e}")
+        await asyncio.sleep(refresh_interval)
+
+
+landmark_table = LandmarkTable(settings.landmark_count)
+graph_index.edge_listeners.append(landmark_table.queue_edges)
@@ -1,8 +1,10 @@
-from fastapi import FastAPI, Depends, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from .models import Base, engine
 from .spotify_service import *
+from .landmarks import landmark_table, run_landmark_job
+from .async_db import AsyncDb, async_db, get_async_db
 from cachetools import TTLCache
 import pytz
 import asyncio
@@ -30,11 +32,17 @@ app.add_middleware(
 )
 
 connections: Dict[str, WebSocket] = {}
+route_searches: Dict[str, asyncio.Task] = {}  # client_id -> its running route search
+grace_tasks: Dict[str, asyncio.Task] = {}  # client_id -> cancel_search_after_grace waiting for it to reconnect
+landmark_task: asyncio.Task = None
 ws_cache = TTLCache(maxsize=1000, ttl=600)
 
 # Function to add a WebSocket connection to the cache
 def add_ws_connection(client_id, websocket):
     connections[client_id] = websocket
+    grace_task = grace_tasks.pop(client_id, None)
+    if grace_task is not None:
+        grace_task.cancel()  # reconnected, its search carries on
     ws_cache[client_id] = {
         'connection': websocket,
         'added_at': datetime.now()
@@ -54,30 +62,115 @@ def get_ws_connection(client_id):
         print(f"No active connection for {client_id} found in cache.")
         return None
 
+class ClientSocket:
+    # Stands in for the websocket during a route search. Sends go to the client's current connection, so a reconnect
+    # (the frontend reconnects under the same id) picks the updates back up, and are dropped while it has none
+    # instead of failing the search.
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+
+    async def send_text(self, text: str):
+        websocket = connections.get(self.client_id)
+        if websocket is None:
+            return
+        try:
+            await websocket.send_text(text)
+        except Exception as e:
+            print(f"Couldnt send update to {self.client_id}: {e}")
+
+async def run_route_search(client_id: str, search: Awaitable[RouteReply], request: Request = None) -> Optional[RouteReply]:
+    # Runs the search as its own task registered under the client, so a disconnect can cancel it: the websocket's
+    # (see cancel_search_after_grace) or, if given, the HTTP request's that is waiting for the result. Returns None if
+    # it was cancelled that way. A newer search from the same client replaces (and cancels) an older one.
+    previous_search = route_searches.get(client_id)
+    if previous_search is not None and not previous_search.done():
+        previous_search.cancel()
+    search_task = asyncio.create_task(search)
+    route_searches[client_id] = search_task
+    request_watcher = asyncio.create_task(cancel_search_on_request_disconnect(request, search_task)) if request is not None else None
+    try:
+        await asyncio.wait([search_task])
+    finally:
+        if request_watcher is not None:
+            request_watcher.cancel()
+        if not search_task.done():
+            search_task.cancel()  # the request itself was cancelled
+        if route_searches.get(client_id) is search_task:
+            del route_searches[client_id]
+    if search_task.cancelled():
+        return None
+    return search_task.result()
+
+async def cancel_search_after_grace(client_id: str):
+    try:
+        await asyncio.sleep(settings.ws_disconnect_grace)
+        if client_id in connections:
+            return  # reconnected in time
+        search_task = route_searches.get(client_id)
+        if search_task is not None and not search_task.done():
+            print(f"Client {client_id} didnt reconnect, cancelling its route search")
+            search_task.cancel()
+    finally:
+        if grace_tasks.get(client_id) is asyncio.current_task():
+            del grace_tasks[client_id]
+
+async def cancel_search_on_request_disconnect(request: Request, search_task: asyncio.Task):
+    # the POST waiting on the search went away (page closed, request aborted), nothing is left to send the route to
+    while not search_task.done():
+        if await request.is_disconnected():
+            print("Route request disconnected, cancelling its search")
+            search_task.cancel()
+            return
+        await asyncio.sleep(1)
+
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
     # Base.metadata.create_all(bind=engine)
-    refresh_access_token()
+    await refresh_access_token()
+    await async_db.run(graph_index.load)
+    await async_db.run(genre_cache.load)
+    global landmark_task
+    landmark_task = asyncio.create_task(run_landmark_job(landmark_table, graph_index, settings.landmark_refresh_interval, settings.landmark_rebuild_interval))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if landmark_task is not None:
+        landmark_task.cancel()
+    await close_http_client()
+    await asyncio.to_thread(response_cache.close)
+    async_db.shutdown()
 
 @app.get("/api")
 def read_root():
     return {"message": "Hello from FastAPI"}
 
 @app.get("/artist/search")
-def search_artists(artist_name: str, max_results: int = 10):
-    return get_artist(artist_name, max_results)
+async def search_artists(artist_name: str, max_results: int = 10):
+    return await get_artist(artist_name, max_results)
 
 @app.get("/artist/{spotify_id}/albums")
-def fetch_artist_albums(spotify_id: str, all_albums: bool = False):
-    return get_artist_albums(spotify_id, all_albums)
+async def fetch_artist_albums(spotify_id: str, all_albums: bool = False):
+    return await get_artist_albums(spotify_id, all_albums)
 
 class RouteRequest(BaseModel):
     starting_artist: Artist
     ending_artist: Artist
     websocket_id: str
+    crawl_policy: Optional[CrawlPolicy] = None  # defaults to DEFAULT_CRAWL_POLICY
+    use_cached_graph: bool = True  # try a search over the stored graph first, only falling back to spotify if that fails
+    route_count: int = 1  # >1 also returns up to route_count - 1 alternative routes (from the same search)
+    # search limits, capped at (and defaulting to) the settings.route_max_* values
+    max_seconds: Optional[float] = None
+    max_expansions: Optional[int] = None
+    max_api_calls: Optional[int] = None
+
+def request_limit(requested, default):
+    # the smaller of what was asked for and the server default, where 0 / None means unlimited
+    limits = [limit for limit in (requested, default) if limit]
+    return min(limits) if limits else None
 
 @app.post("/routes/find")
-async def fetch_route(route_request: RouteRequest, send_full_graph=True, db: Session=Depends(get_db), require_ws_connection=True) -> RouteReply:
+async def fetch_route(route_request: RouteRequest, request: Request, send_full_graph=True, db: AsyncDb=Depends(get_async_db), require_ws_connection=True) -> RouteReply:
     
     startingArtist = route_request.starting_artist
     endingArtist = route_request.ending_artist
@@ -86,14 +179,65 @@ async def fetch_route(route_request: RouteRequest, send_full_graph=True, db: Ses
     ws_connection = get_ws_connection(websocket_id)
     if require_ws_connection and ws_connection == None: 
         raise HTTPException(status_code=440, detail="No WS Connection found, reestablish connection")
+    if ws_connection is not None:
+        ws_connection = ClientSocket(websocket_id)
 
-    route_reply: RouteReply = await find_route(startingArtist, endingArtist, ws_connection, db, send_full_graph=send_full_graph)
+    route_reply: RouteReply = None
+    route_count = max(1, route_request.route_count)
+    if route_request.use_cached_graph and route_count == 1:  # both caches only hold a single route
+        route_reply = await find_recent_route(startingArtist, endingArtist, ws_connection, send_full_graph=send_full_graph)
+        if route_reply is not None:
+            return {"route_list": remove_connections(route_reply.route_list), "graph": route_reply.graph}
+        route_reply = await find_cached_route(startingArtist, endingArtist, ws_connection, send_full_graph=send_full_graph)
+    if route_reply is None:
+        budget = SearchBudget(max_seconds=request_limit(route_request.max_seconds, settings.route_max_seconds),
+                              max_expansions=request_limit(route_request.max_expansions, settings.route_max_expansions),
+                              max_api_calls=request_limit(route_request.max_api_calls, settings.route_max_api_calls))
+        route_reply = await run_route_search(websocket_id, find_route(startingArtist, endingArtist, ws_connection, db, send_full_graph=send_full_graph,
+                                                                      crawl_policy=route_request.crawl_policy, route_count=route_count, budget=budget),
+                                             request)
+        if route_reply is None:
+            raise HTTPException(status_code=499, detail="Route search cancelled, client disconnected")
+    if route_reply.best_effort is not None:
+        # ran out of budget, still a result (not an error) so the client can show how far it got
+        return {"route_list": [], "graph": route_reply.graph if send_full_graph else None, "alternative_routes": [],
+                "best_effort": route_reply.best_effort}
     if route_reply.route_list == []:
         raise HTTPException(status_code=404, detail="No route found between the specified artists. Potential closed loop chosen for starting or ending artist.")
+    remember_route(route_reply)
     
     print(f"route = [{', '.join([artist.name for artist in route_reply.route_list])}]")
     return {"route_list": remove_connections(route_reply.route_list), 
-            "graph": route_reply.graph if send_full_graph else None}
+            "graph": route_reply.graph if send_full_graph else None,
+            "alternative_routes": [remove_connections(route) for route in route_reply.alternative_routes],
+            "alternatives_proven": route_reply.alternatives_proven}
+
+class RoutePair(BaseModel):
+    starting_artist: Artist
+    ending_artist: Artist
+
+class BatchRouteRequest(BaseModel):
+    pairs: List[RoutePair]
+    crawl_policy: Optional[CrawlPolicy] = None
+    use_cached_graph: bool = True
+    # limits shared by every pair, capped at (and defaulting to) the settings.batch_route_max_* values
+    max_seconds: Optional[float] = None
+    max_expansions: Optional[int] = None
+    max_api_calls: Optional[int] = None
+    concurrency: Optional[int] = None  # capped at (and defaulting to) settings.batch_route_concurrency
+
+@app.post("/routes/find/batch")
+async def fetch_routes_batch(batch_request: BatchRouteRequest, db: AsyncDb=Depends(get_async_db)):
+    if len(batch_request.pairs) > settings.batch_route_max_pairs:
+        raise HTTPException(status_code=400, detail=f"Too many pairs, at most {settings.batch_route_max_pairs} per batch")
+    budget = SearchBudget(max_seconds=request_limit(batch_request.max_seconds, settings.batch_route_max_seconds),
+                          max_expansions=request_limit(batch_request.max_expansions, settings.batch_route_max_expansions),
+                          max_api_calls=request_limit(batch_request.max_api_calls, settings.batch_route_max_api_calls))
+    results, expansions_used = await find_routes_batch([(pair.starting_artist, pair.ending_artist) for pair in batch_request.pairs], db,
+                                                       crawl_policy=batch_request.crawl_policy, use_cached_graph=batch_request.use_cached_graph,
+                                                       budget=budget, concurrency=request_limit(batch_request.concurrency, settings.batch_route_concurrency))
+    print(f"Batch of {len(results)} routes done, {expansions_used} artists expanded")
+    return {"routes": results, "expansions_used": expansions_used}
 
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
@@ -126,8 +270,11 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             print(f"Received message from {client_id}: {data}")
     except WebSocketDisconnect:
         print(f"Client {client_id} disconnected")
-        del connections[client_id]
         ping_task.cancel()
+        if connections.get(client_id) is websocket:  # a stale socket closing mustnt drop the client's newer one
+            del connections[client_id]
+            if client_id in route_searches and client_id not in grace_tasks:
+                grace_tasks[client_id] = asyncio.create_task(cancel_search_after_grace(client_id))
         print(f"Client {client_id} removed from connections. Current connections: {list(connections.keys())}")
 
 
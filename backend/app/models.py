@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Table, UniqueConstraint
+from sqlalchemy import create_engine, inspect, text, Column, Index, Integer, String, Boolean, DateTime, ForeignKey, Table, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from datetime import datetime
@@ -18,7 +18,8 @@ artist_genre_association = Table(
     'artist_genre',
     Base.metadata,
     Column('artist_id', String, ForeignKey('artists.id')),
-    Column('genre_id', Integer, ForeignKey('genres.id'))
+    Column('genre_id', Integer, ForeignKey('genres.id')),
+    Index('unique_artist_genre', 'artist_id', 'genre_id', unique=True)  # lets genre links be upserted
 )
 
 class Artist(Base):
@@ -31,6 +32,7 @@ class Artist(Base):
     popularity = Column(Integer)
     last_updated = Column(DateTime, default=utcnow)
     is_full_artist = Column(Boolean)  # would be True if the connections are defined
+    crawl_policy = Column(String)  # CrawlPolicy.key() all the stored connections were found under, "mixed" if not one, null for older rows
 
     connections = relationship(
         "Connection",
@@ -71,10 +73,17 @@ class Connection(Base):
         overlaps="connections"
     )
     
+    # Connections are undirected and stored once, with the smaller id as artist_id (see canonical_connection).
+    # The unique constraint covers lookups by artist_id, the second index lookups by related_artist_id.
     __table_args__ = (
         UniqueConstraint('artist_id', 'related_artist_id', name='unique_artist_connection'),
+        Index('connections_related_artist_id', 'related_artist_id'),
     )
 
+def canonical_connection(artist_id: str, related_artist_id: str):
+    # the (artist_id, related_artist_id) a connection between the two is stored as
+    return (artist_id, related_artist_id) if artist_id < related_artist_id else (related_artist_id, artist_id)
+
 
 class Genre(Base):
     __tablename__ = "genres"
@@ -88,3 +97,40 @@ class Genre(Base):
 # TODO: add linking between artists and genres. 
 
 Base.metadata.create_all(bind=engine)
+
+def upgrade_schema():
+    # create_all only makes missing tables, so columns / indexes added to existing tables are added here.
+    inspector = inspect(engine)
+    artist_columns = {column['name'] for column in inspector.get_columns('artists')}
+    artist_genre_indexes = {index['name'] for index in inspector.get_indexes('artist_genre')}
+    connection_indexes = {index['name'] for index in inspector.get_indexes('connections')}
+    with engine.begin() as connection:
+        if 'crawl_policy' not in artist_columns:
+            connection.execute(text("ALTER TABLE artists ADD COLUMN crawl_policy VARCHAR"))
+        if 'unique_artist_genre' not in artist_genre_indexes:
+            # older databases can have the same link twice, which would stop the unique index being created
+            duplicates = connection.execute(text(
+                "SELECT artist_id, genre_id FROM artist_genre GROUP BY artist_id, genre_id HAVING COUNT(*) > 1")).all()
+            for artist_id, genre_id in duplicates:
+                link = {"artist_id": artist_id, "genre_id": genre_id}
+                connection.execute(text("DELETE FROM artist_genre WHERE artist_id = :artist_id AND genre_id = :genre_id"), link)
+                connection.execute(text("INSERT INTO artist_genre (artist_id, genre_id) VALUES (:artist_id, :genre_id)"), link)
+            connection.execute(text("CREATE UNIQUE INDEX unique_artist_genre ON artist_genre (artist_id, genre_id)"))
+        # ids are compared bytewise to match the codepoint order canonical_connection uses, a locale collation (e.g
+        # en_US.UTF-8) orders mixed case spotify ids differently. sqlite compares bytewise by default, postgres needs "C"
+        artist_id = 'artist_id COLLATE "C"' if engine.dialect.name == "postgresql" else "artist_id"
+        # also run when rows are out of order, databases migrated before the comparison was bytewise can have some
+        if 'connections_related_artist_id' not in connection_indexes or connection.execute(text(
+                f"SELECT EXISTS (SELECT 1 FROM connections WHERE {artist_id} > related_artist_id)")).scalar():
+            # older databases stored connections in whichever direction they were found (sometimes both),
+            # drops the reversed copies of rows that exist both ways then flips the rest to smaller id first
+            connection.execute(text(f"""
+                DELETE FROM connections WHERE {artist_id} >= related_artist_id AND (artist_id = related_artist_id OR EXISTS (
+                    SELECT 1 FROM connections AS canonical
+                    WHERE canonical.artist_id = connections.related_artist_id AND canonical.related_artist_id = connections.artist_id))"""))
+            connection.execute(text(
+                f"UPDATE connections SET artist_id = related_artist_id, related_artist_id = artist_id WHERE {artist_id} > related_artist_id"))
+        if 'connections_related_artist_id' not in connection_indexes:
+            connection.execute(text("CREATE INDEX connections_related_artist_id ON connections (related_artist_id)"))
+
+upgrade_schema()
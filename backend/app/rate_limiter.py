@@ -0,0 +1,120 @@
+import time
+import asyncio
+import heapq
+import itertools
+from contextvars import ContextVar
+from typing import List, Optional, Set, Tuple
+
+class CallPriority:
+    """
+    Priority (lower goes first) shared by every call a piece of work makes. It is a mutable holder rather than a
+    plain int so work started in the background can be promoted once something is actually waiting on it: promote()
+    also moves the calls it already has queued, and the work that follows it (see follow) along with it.
+    """
+
+    def __init__(self, value: int):
+        self.value = value
+        self.limiters: Set["RateLimiter"] = set()  # limiters it has calls queued on
+        self.followers: List["CallPriority"] = []
+
+    def promote(self, value: int):
+        if value < self.value:
+            self.value = value
+            for limiter in self.limiters:
+                limiter.reprioritise()
+            for follower in self.followers:
+                follower.promote(value)
+
+    def follow(self, leader: Optional["CallPriority"]):
+        # Runs at least as urgently as leader from now on, leader None being a foreground caller (priority 0).
+        # Used for work someone else is waiting on, e.g a crawl joined by another route.
+        if leader is None:
+            self.promote(0)
+        else:
+            self.promote(leader.value)
+            leader.followers.append(self)
+
+# Priority for spotify calls made in the current task, None for the default of 0. Set it once around a piece of work
+# (e.g. background prefetching) rather than threading a priority argument through every function.
+spotify_call_priority: ContextVar[Optional[CallPriority]] = ContextVar("spotify_call_priority", default=None)
+
+def current_call_priority() -> int:
+    priority = spotify_call_priority.get()
+    return 0 if priority is None else priority.value
+
+class RateLimiter:
+    """
+    Async token bucket shared by every spotify call.
+    Tokens refill continuously at (rate_limit - burst) / window_seconds, with at most `burst` saved up, so no rolling
+    window can see more than burst + (rate_limit - burst) = rate_limit calls. Waiters are served by priority then arrival order.
+    """
+
+    def __init__(self, rate_limit: int, window_seconds: float, burst: int):
+        burst = max(1, min(burst, rate_limit - 1))
+        self.capacity = burst
+        self.refill_rate = (rate_limit - burst) / window_seconds  # tokens per second
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0  # set when spotify still answers with a 429
+        self.waiters: List[Tuple[int, int, asyncio.Future, Optional[CallPriority]]] = []  # (priority, arrival order, future, its holder)
+        self.arrival_counter = itertools.count()
+        self.dispatcher: asyncio.Task = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    def _time_until_token(self) -> float:
+        blocked_for = self.blocked_until - time.monotonic()
+        refill_wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.refill_rate
+        return max(blocked_for, refill_wait, 0)
+
+    async def acquire(self, priority: int = None):
+        holder = None
+        if priority is None:
+            holder = spotify_call_priority.get()
+            priority = 0 if holder is None else holder.value
+        self._refill()
+        if not self.waiters and self._time_until_token() == 0:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.arrival_counter), future, holder))
+        if holder is not None:
+            holder.limiters.add(self)
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        await future  # a cancelled caller leaves a cancelled future behind, which _dispatch skips
+
+    async def _dispatch(self):
+        while self.waiters:
+            self._refill()
+            wait = self._time_until_token()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future, _ = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+
+    def reprioritise(self):
+        # a CallPriority was promoted, re-reads the priority of every queued call that has a holder
+        self.waiters = [(holder.value if holder is not None else priority, arrival, future, holder)
+                        for priority, arrival, future, holder in self.waiters if not future.done()]
+        heapq.heapify(self.waiters)
+
+    def penalise(self, retry_after: float):
+        # spotify disagrees with our count, so hold every caller back until its Retry-After has passed
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def current_wait_time(self) -> float:
+        # estimated seconds a new call would wait for its token
+        self._refill()
+        queued = sum(1 for _, _, future, _ in self.waiters if not future.done())
+        missing_tokens = queued + 1 - self.tokens
+        refill_wait = missing_tokens / self.refill_rate if missing_tokens > 0 else 0
+        return max(refill_wait, self.blocked_until - time.monotonic(), 0)
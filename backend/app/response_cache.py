@@ -0,0 +1,155 @@
+import json
+import time
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+from cachetools import TLRUCache
+
+TOUCH_BATCH_SIZE = 1000  # disk hits whose accessed_at updates are written back together
+
+class ResponseCache:
+    """
+    Two level cache for raw spotify payloads.
+    Memory is an expiry + LRU bounded TLRUCache per endpoint, backed by a small sqlite file so entries survive restarts.
+    Every entry expires endpoint TTL after it was fetched from spotify, a disk hit brought back into memory only gets
+    whatever is left of its TTL.
+    Batched endpoints (albums, artists) are stored per ID rather than per URL so any batch can reuse them.
+    The sqlite side is only touched from its own thread, reads are awaited and writes are queued, so a slow disk
+    never holds up the event loop.
+    """
+
+    def __init__(self, path: str, ttls: Dict[str, float], memory_size: int, disk_size: int):
+        self.ttls = ttls
+        self.disk_size = disk_size
+        # values are (expires_at, payload), expires_at in time.time() terms like stored_at on disk
+        self.memory: Dict[str, TLRUCache] = {
+            endpoint: TLRUCache(maxsize=memory_size, ttu=lambda _key, entry, _now: entry[0], timer=time.time)
+            for endpoint, ttl in ttls.items() if ttl > 0
+        }
+        self.writes_since_prune = 0
+        # (endpoint, key) -> time of the disk hits not yet written back, so reads dont have to write
+        self.pending_touches: Dict[Tuple[str, str], float] = {}
+        # All disk work runs on this one thread, off the event loop. Being a single thread it also keeps sqlite to one
+        # writer and runs reads after the writes queued before them.
+        self.disk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+        self.disk = sqlite3.connect(path, check_same_thread=False)
+        self.disk.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                endpoint TEXT NOT NULL,
+                key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (endpoint, key)
+            )""")
+        self.disk.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.disk.commit()
+
+    def is_cached_endpoint(self, endpoint: str) -> bool:
+        return endpoint in self.memory
+
+    async def get(self, endpoint: str, key: str) -> Optional[dict]:
+        return (await self.get_many(endpoint, [key])).get(key)
+
+    async def get_many(self, endpoint: str, keys: Iterable[str]) -> Dict[str, dict]:
+        if not self.is_cached_endpoint(endpoint):
+            return {}
+        memory = self.memory[endpoint]
+        found = {}
+        missing = []
+        for key in keys:
+            entry = memory.get(key)
+            if entry is not None:
+                found[key] = entry[1]
+            else:
+                missing.append(key)
+        if missing:
+            disk_found = await asyncio.get_running_loop().run_in_executor(self.disk_executor, self._read_disk, endpoint, missing)
+            ttl = self.ttls[endpoint]
+            for key in missing:
+                entry = memory.get(key)  # anything put while reading is newer than the disk copy
+                if entry is None and key in disk_found:
+                    stored_at, payload = disk_found[key]
+                    entry = (stored_at + ttl, payload)
+                    memory[key] = entry
+                if entry is not None:
+                    found[key] = entry[1]
+        return found
+
+    def put(self, endpoint: str, key: str, payload: dict):
+        self.put_many(endpoint, {key: payload})
+
+    def put_many(self, endpoint: str, payloads: Dict[str, dict]):
+        # memory is updated straight away, the disk write is queued on the disk thread and not waited for
+        if not self.is_cached_endpoint(endpoint) or not payloads:
+            return
+        memory = self.memory[endpoint]
+        expires_at = time.time() + self.ttls[endpoint]
+        for key, payload in payloads.items():
+            memory[key] = (expires_at, payload)
+        self.disk_executor.submit(self._write_disk, endpoint, dict(payloads))
+
+    def close(self):
+        # writes back the outstanding accessed_at updates and waits for queued writes
+        self.disk_executor.submit(self._flush_touches)
+        self.disk_executor.shutdown(wait=True)
+
+    def _write_disk(self, endpoint: str, payloads: Dict[str, dict]):
+        try:
+            now = time.time()
+            rows = [(endpoint, key, json.dumps(payload), now, now) for key, payload in payloads.items()]
+            self._write_touches()
+            self.disk.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", rows)
+            self.disk.commit()
+            self.writes_since_prune += len(rows)
+            if self.writes_since_prune > self.disk_size // 10:
+                self._prune_disk()
+        except Exception as e:
+            print(f"Response cache write failed: {e}")
+
+    def _read_disk(self, endpoint: str, keys: list) -> Dict[str, Tuple[float, dict]]:
+        # key -> (stored_at, payload) for the keys stored and not expired
+        now = time.time()
+        oldest_valid = now - self.ttls[endpoint]
+        found = {}
+        for index in range(0, len(keys), 500):  # keeps under sqlite's bound parameter limit
+            key_chunk = keys[index:index+500]
+            placeholders = ','.join('?' * len(key_chunk))
+            rows = self.disk.execute(
+                f"SELECT key, stored_at, payload FROM responses WHERE endpoint = ? AND stored_at > ? AND key IN ({placeholders})",
+                [endpoint, oldest_valid, *key_chunk]
+            ).fetchall()
+            found.update({key: (stored_at, json.loads(payload)) for key, stored_at, payload in rows})
+        for key in found:
+            self.pending_touches[(endpoint, key)] = now
+        if len(self.pending_touches) >= TOUCH_BATCH_SIZE:
+            self.disk_executor.submit(self._flush_touches)  # runs after this read, not as part of it
+        return found
+
+    def _write_touches(self):
+        # only ever run on the disk thread, the caller commits
+        if self.pending_touches:
+            touches, self.pending_touches = self.pending_touches, {}
+            self.disk.executemany("UPDATE responses SET accessed_at = ? WHERE endpoint = ? AND key = ?",
+                                  [(accessed_at, endpoint, key) for (endpoint, key), accessed_at in touches.items()])
+
+    def _flush_touches(self):
+        try:
+            self._write_touches()
+            self.disk.commit()
+        except Exception as e:
+            print(f"Response cache write failed: {e}")
+
+    def _prune_disk(self):
+        # drops expired rows, then the least recently used ones beyond disk_size
+        self.writes_since_prune = 0
+        self._write_touches()
+        now = time.time()
+        for endpoint, ttl in self.ttls.items():
+            self.disk.execute("DELETE FROM responses WHERE endpoint = ? AND stored_at <= ?", (endpoint, now - ttl))
+        self.disk.execute("""
+            DELETE FROM responses WHERE rowid IN (
+                SELECT rowid FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )""", (self.disk_size,))
+        self.disk.commit()
@@ -0,0 +1,67 @@
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from cachetools import TTLCache
+from .dtos import Artist, GraphStructure
+from .graph_index import graph_index
+from .config import settings
+
+class CachedRoute(NamedTuple):
+    route_list: List[Artist]  # in the direction it was found, connections stripped
+    graph: Optional[GraphStructure]  # final graph of the search that found it, if it was kept
+
+class RouteCache:
+    """
+    Recently found routes, keyed by the unordered (starting id, ending id) pair with TTL + LRU bounds.
+    An entry is dropped as soon as any artist on its route gets new connections saved, a new edge there could
+    mean a shorter route now exists.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.artist_keys: Dict[str, Set[Tuple[str, str]]] = {}  # artist id -> keys of the routes its on
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(starting_id: str, ending_id: str) -> Tuple[str, str]:
+        return (starting_id, ending_id) if starting_id <= ending_id else (ending_id, starting_id)
+
+    def get(self, starting_id: str, ending_id: str) -> Optional[CachedRoute]:
+        # The route oriented starting -> ending. A route stored the other way round comes back reversed without its
+        # graph, as the graph's depths are measured from the other end.
+        with self.lock:
+            cached_route = self.entries.get(self.key(starting_id, ending_id))
+        if cached_route is None:
+            return None
+        if cached_route.route_list[0].id == starting_id:
+            return cached_route
+        return CachedRoute(cached_route.route_list[::-1], None)
+
+    def put(self, route_list: List[Artist], graph: Optional[GraphStructure] = None):
+        if len(route_list) < 2:
+            return
+        route_list = [artist.model_copy(update={"connections": None}) for artist in route_list]
+        key = self.key(route_list[0].id, route_list[-1].id)
+        with self.lock:
+            self.entries[key] = CachedRoute(route_list, graph)
+            for artist in route_list:
+                self.artist_keys.setdefault(artist.id, set()).add(key)
+            if len(self.artist_keys) > self.entries.maxsize * 10:
+                self._prune_artist_keys()
+
+    def invalidate(self, artist_ids: Iterable[str]):
+        with self.lock:
+            for artist_id in artist_ids:
+                for key in self.artist_keys.pop(artist_id, ()):
+                    self.entries.pop(key, None)
+
+    def _prune_artist_keys(self):
+        # expired / evicted entries leave their keys behind in artist_keys, this rebuilds it from whats still cached
+        self.artist_keys = {}
+        for key, cached_route in self.entries.items():
+            for artist in cached_route.route_list:
+                self.artist_keys.setdefault(artist.id, set()).add(key)
+
+
+route_cache = RouteCache(settings.route_cache_size, settings.route_cache_ttl)
+graph_index.edge_listeners.append(
+    lambda edges: route_cache.invalidate({graph_index.artist_ids[number] for edge in edges for number in edge}))
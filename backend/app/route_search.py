@@ -0,0 +1,330 @@
+import time
+import heapq
+import asyncio
+import itertools
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+from .dtos import Artist
+from .rate_limiter import CallPriority, current_call_priority, spotify_call_priority
+
+def calculate_weight(selected_artist : Artist, target_artist : Artist, depth : int) -> int:
+
+    # calculate a weight, representing how likely (as a guess) they are to lead to the target artist.
+    # should be calculated as a number representing
+    # 1. how many genres they share (max 1 for if selectedArtist contains all genres of the targetArtist)
+    # 2. their popularity score (scaling from 0.75 to 1 based on their popularity)
+    # 3. depth from the starting artist (reducing by 0.15 for each depth (hoping that the six degrees of seperation applies and no more than 5 is ever needed))
+    selected_genres = set(selected_artist.genres or [])
+    target_genres = set(target_artist.genres or [])
+
+    # Calculate shared genres weight
+    if target_genres & selected_genres:
+        shared_genres_ratio = len(selected_genres.intersection(target_genres)) / len(target_genres)
+    elif target_genres:
+        shared_genres_ratio = 0.75 # random value really, just so it has an effect, normally no genres probably means low popularity too.
+    else:
+        shared_genres_ratio = 1 # due to target not having any genres, will not be relevant in calcuation.
+    popularity_weight = 0.75 + (0.25 * (selected_artist.popularity / 100))
+    depth_penalty = max(0, 1 - (0.15 * depth))
+    answer = shared_genres_ratio * popularity_weight * depth_penalty
+    return answer
+
+
+class GenreBits:
+    """
+    Interns genre names to bit positions, so an artist's genres become one int and the genres two artists share are
+    a single `&` (spotify only has a few thousand genres, so the masks stay small).
+    """
+
+    def __init__(self):
+        self.bits: Dict[str, int] = {}
+
+    def mask(self, genres) -> int:
+        mask = 0
+        for genre in genres:
+            bit = self.bits.get(genre)
+            if bit is None:
+                bit = self.bits[genre] = len(self.bits)
+            mask |= 1 << bit
+        return mask
+
+genre_bits = GenreBits()
+
+def score_records(records: List['ArtistRecord'], target: 'ArtistRecord', depth: int) -> List[float]:
+    # calculate_weight for a batch of records all at the same depth (the new connections of one expansion), using the
+    # genre masks instead of building two sets per artist. The depth penalty and target genre count are worked out once.
+    depth_penalty = max(0, 1 - (0.15 * depth))
+    target_mask = target.genre_mask
+    target_genre_count = target_mask.bit_count()
+    no_shared_ratio = 0.75 if target_genre_count else 1  # same fallbacks as calculate_weight
+    weights = []
+    for record in records:
+        shared_count = (record.genre_mask & target_mask).bit_count()
+        shared_genres_ratio = shared_count / target_genre_count if shared_count else no_shared_ratio
+        weights.append(shared_genres_ratio * (0.75 + (0.25 * (record.popularity / 100))) * depth_penalty)
+    return weights
+
+
+class ArtistRecord(NamedTuple):
+    # What the search keeps per discovered artist, instead of the full Artist (and its nested connections).
+    # Has the same field names calculate_weight reads, so it can be scored directly.
+    id: str
+    name: str
+    artURL: str
+    followers: int
+    popularity: int
+    genres: Tuple[str, ...]
+    depth: int
+    genre_mask: int = 0  # genres as genre_bits, for score_records
+
+    @classmethod
+    def from_artist(cls, artist: Artist, depth: int) -> 'ArtistRecord':
+        genres = tuple(artist.genres or ())
+        return cls(artist.id, artist.name, artist.artURL, artist.followers, artist.popularity, genres, depth, genre_bits.mask(genres))
+
+    def to_artist(self) -> Artist:
+        return Artist(
+            id=self.id,
+            artURL=self.artURL,
+            followers=self.followers,
+            name=self.name,
+            popularity=self.popularity,
+            lastUpdated=None,
+            connections=[],
+            genres=list(self.genres)
+        )
+
+
+class Frontier:
+    """
+    Priority queue of artists waiting to be expanded, best first: highest weight, then deepest, then most popular
+    (the same order sort_by_weight used to produce). Weights are worked out once when an artist is pushed.
+    When the search has a landmark heuristic, the lowest estimated route length (depth + lower bound to the target)
+    comes first and the weight only breaks ties, making it A*.
+    """
+
+    def __init__(self):
+        self.heap: List[tuple] = []
+        self.artist_ids: Set[str] = set()
+        self.push_counter = itertools.count()  # tie breaker (newest first, as the old sorted list popped) so records are never compared
+        self.depth_counts: Dict[int, int] = {}  # how many queued artists sit at each depth, for min_depth()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def __contains__(self, artist_id: str) -> bool:
+        return artist_id in self.artist_ids
+
+    def push(self, record: ArtistRecord, weight: float, estimate: int = 0):
+        heapq.heappush(self.heap, (estimate, -weight, -record.depth, -record.popularity, -next(self.push_counter), record))
+        self.artist_ids.add(record.id)
+        self.depth_counts[record.depth] = self.depth_counts.get(record.depth, 0) + 1
+
+    def pop(self) -> Tuple[ArtistRecord, float]:
+        _, negative_weight, *_, record = heapq.heappop(self.heap)
+        self.artist_ids.discard(record.id)
+        self.depth_counts[record.depth] -= 1
+        if self.depth_counts[record.depth] == 0:
+            del self.depth_counts[record.depth]
+        return record, -negative_weight
+
+    def min_depth(self) -> Optional[int]:
+        # shallowest depth still queued (there are only ever a handful of depths), None when empty
+        return min(self.depth_counts) if self.depth_counts else None
+
+    def peek(self, count: int) -> List[ArtistRecord]:
+        # the next `count` records pop() would return, without removing them (O(count log n))
+        entries = [heapq.heappop(self.heap) for _ in range(min(count, len(self.heap)))]
+        for entry in entries:
+            heapq.heappush(self.heap, entry)
+        return [entry[-1] for entry in entries]
+
+
+class SearchSide:
+    """
+    One half of the bidirectional route search, growing outwards from `root` and scoring its frontier towards `target`
+    (the root of the other side). Discovered artists are stored as a compact record plus the id of the artist they
+    were reached from, paths are only rebuilt (by following parents) once a route is found.
+    `heuristic` (optional) gives a lower bound on the hops from an artist to the target, see landmarks.py.
+    """
+
+    def __init__(self, root: Artist, target: Artist, is_forward: bool, heuristic: Optional[Callable[[str], int]] = None):
+        self.root = root
+        self.target = target
+        self.is_forward = is_forward  # forward grows from the starting artist, backward from the ending artist
+        self.heuristic = heuristic
+        self.frontier = Frontier()
+        self.target_record = ArtistRecord.from_artist(target, 0)
+        self.records: Dict[str, ArtistRecord] = {root.id: ArtistRecord.from_artist(root, 0)}
+        self.parents: Dict[str, Optional[str]] = {root.id: None}
+        self.expanded: Set[str] = set()
+        self.depth_reached = 0  # deepest artist expanded so far
+
+    def has_frontier(self) -> bool:
+        return len(self.frontier) > 0
+
+    def frontier_size(self) -> int:
+        return len(self.frontier)
+
+    def has_discovered(self, artist_id: str) -> bool:
+        return artist_id in self.parents
+
+    def pop_best(self) -> Tuple[ArtistRecord, float]:
+        return self.frontier.pop()
+
+    def expand(self, artist_id: str, connections: List[Artist]):
+        # adds the newly found connections of the (already discovered) artist to the frontier,
+        # only touching the new connections so the cost doesnt grow with the size of the frontier
+        self.expanded.add(artist_id)
+        depth = self.records[artist_id].depth + 1
+        self.depth_reached = max(self.depth_reached, depth - 1)
+        new_records = []
+        for connection in connections:
+            if connection.id not in self.parents:
+                record = ArtistRecord.from_artist(connection, depth)
+                self.parents[connection.id] = artist_id
+                self.records[connection.id] = record
+                new_records.append(record)
+        for record, weight in zip(new_records, score_records(new_records, self.target_record, depth)):
+            estimate = depth + self.heuristic(record.id) if self.heuristic else 0
+            self.frontier.push(record, weight, estimate)
+
+    def find_meetings(self, artist_id: str, connections: List[Artist], other_side: 'SearchSide') -> List[List[ArtistRecord]]:
+        # checks the connections of the artist this side just expanded against everything the other side has discovered,
+        # returning every full starting -> ending route through it (one per artist they touch at).
+        # Routes that would visit an artist twice (both sides reached it by different parents) are skipped.
+        meeting_ids = [artist_id] if other_side.has_discovered(artist_id) else []
+        meeting_ids.extend(connection.id for connection in connections if other_side.has_discovered(connection.id))
+        routes = []
+        for meeting_id in dict.fromkeys(meeting_ids):
+            route = self.join_paths(artist_id, meeting_id, other_side)
+            if len({record.id for record in route}) == len(route):
+                routes.append(route)
+        return routes
+
+    def path_to(self, artist_id: str) -> List[ArtistRecord]:
+        # root -> artist, following parent pointers back from the artist
+        path = []
+        while artist_id is not None:
+            path.append(self.records[artist_id])
+            artist_id = self.parents[artist_id]
+        return path[::-1]
+
+    def join_paths(self, own_artist_id: str, other_artist_id: str, other_side: 'SearchSide') -> List[ArtistRecord]:
+        own_path = self.path_to(own_artist_id)
+        other_path = other_side.path_to(other_artist_id)
+        if own_artist_id == other_artist_id:
+            other_path = other_path[:-1]  # the meeting artist would otherwise appear twice
+        forward_path, backward_path = (own_path, other_path) if self.is_forward else (other_path, own_path)
+        return forward_path + backward_path[::-1]
+
+
+def route_weight(route: List[ArtistRecord]) -> float:
+    # how good a route looks (higher is better) beyond its length, the mean weight of the artists between its two ends
+    middle = route[1:-1]
+    if not middle:
+        return 1.0
+    return sum(calculate_weight(record, route[-1], depth) for depth, record in enumerate(middle, start=1)) / len(middle)
+
+def rank_routes(routes: List[List[ArtistRecord]]) -> List[List[ArtistRecord]]:
+    # shortest first, then by route_weight
+    return sorted(routes, key=lambda route: (len(route), -route_weight(route)))
+
+
+class SearchBudget:
+    """
+    Limits on a route search: wall time, artists expanded and spotify calls made (None = unlimited). Can be shared by
+    several searches, e.g all the pairs of a batch. Spotify calls are counted by make_spotify_call, for every call made
+    while the budget is set in spotify_call_budget (including from tasks the search starts, like prefetches).
+    Limits are checked between expansions, so one expansion's crawl can run a little over max_api_calls.
+    """
+
+    def __init__(self, max_seconds: Optional[float] = None, max_expansions: Optional[int] = None, max_api_calls: Optional[int] = None):
+        self.max_seconds = max_seconds
+        self.max_expansions = max_expansions
+        self.max_api_calls = max_api_calls
+        self.started = time.monotonic()
+        self.expansions = 0
+        self.api_calls = 0
+        self.exhausted_reason: Optional[str] = None  # which limit ran out, once one has
+
+    def elapsed_seconds(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining_seconds(self) -> Optional[float]:
+        return None if self.max_seconds is None else max(0.0, self.max_seconds - self.elapsed_seconds())
+
+    def is_exhausted(self) -> bool:
+        if self.exhausted_reason is None:
+            if self.max_seconds is not None and self.elapsed_seconds() >= self.max_seconds:
+                self.exhausted_reason = "time"
+            elif self.max_expansions is not None and self.expansions >= self.max_expansions:
+                self.exhausted_reason = "expansions"
+            elif self.max_api_calls is not None and self.api_calls >= self.max_api_calls:
+                self.exhausted_reason = "api_calls"
+        return self.exhausted_reason is not None
+
+    def spend_expansion(self) -> bool:
+        # False (without spending) once any limit has run out
+        if self.is_exhausted():
+            return False
+        self.expansions += 1
+        return True
+
+    def usage(self) -> Dict[str, Union[int, float]]:
+        return {"elapsed_seconds": round(self.elapsed_seconds(), 2), "expansions": self.expansions, "api_calls": self.api_calls}
+
+
+PREFETCH_PRIORITY = 1  # added to the searches own priority, so prefetches queue behind any call a route is actually waiting on
+BATCH_PRIORITY = 2  # batch searches queue behind interactive ones (priority 0) and their prefetches
+
+class Prefetcher:
+    """
+    Speculatively fetches connections for the artists the search is likely to expand next, in background tasks whose
+    spotify calls queue behind everything else on the rate limiter. The search takes the result when it gets to that
+    artist, promoting the fetch to the search's own priority if it has to wait for it; anything still pending when
+    the search ends is cancelled.
+    """
+
+    def __init__(self, fetch_connections: Callable[[Artist], Awaitable[List[Artist]]], size: int):
+        self.fetch_connections = fetch_connections
+        self.size = size
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.priorities: Dict[str, CallPriority] = {}  # artist id -> priority its fetch runs at
+
+    def pending_count(self) -> int:
+        return sum(1 for task in self.tasks.values() if not task.done())
+
+    def prefetch(self, records: List[ArtistRecord]):
+        for record in records:
+            if self.pending_count() >= self.size:
+                return
+            if record.id not in self.tasks:
+                self.priorities[record.id] = CallPriority(current_call_priority() + PREFETCH_PRIORITY)
+                task = asyncio.create_task(self._fetch(record.to_artist(), self.priorities[record.id]))
+                task.add_done_callback(lambda done_task: done_task.cancelled() or done_task.exception())  # failures are retried by take()
+                self.tasks[record.id] = task
+
+    async def _fetch(self, artist: Artist, priority: CallPriority) -> Artist:
+        spotify_call_priority.set(priority)  # only affects this task's copy of the context
+        artist.connections = await self.fetch_connections(artist) or []
+        return artist
+
+    async def take(self, artist_id: str) -> Optional[Artist]:
+        # the prefetched artist (with connections), waiting for it if its still in flight. None if it wasnt prefetched or failed
+        task = self.tasks.pop(artist_id, None)
+        priority = self.priorities.pop(artist_id, None)
+        if task is None:
+            return None
+        if not task.done():
+            priority.follow(spotify_call_priority.get())  # the search is waiting on it now
+        try:
+            return await task
+        except Exception as e:
+            print(f"Prefetch for {artist_id} failed, fetching directly: {e}")
+            return None
+
+    def cancel_all(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
+        self.priorities = {}
@@ -0,0 +1,47 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable
+from .rate_limiter import CallPriority, spotify_call_priority, current_call_priority
+
+class Flight:
+    def __init__(self, task: asyncio.Task, priority: CallPriority):
+        self.task = task
+        self.priority = priority
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller starts the work, anyone arriving while it is
+    still running awaits that same task instead of starting their own.
+    The work is only cancelled once every caller waiting on it has been cancelled.
+    Its spotify calls run at the most urgent priority of the callers waiting on it, so a crawl started by a
+    background prefetch isnt left queueing at prefetch priority once a route joins it.
+    """
+
+    def __init__(self):
+        self.flights: Dict[Hashable, Flight] = {}
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        return key in self.flights
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable]):
+        flight = self.flights.get(key)
+        if flight is None:
+            priority = CallPriority(current_call_priority())
+            flight = Flight(asyncio.create_task(self._run_at(priority, work)), priority)
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda _: self.flights.pop(key, None) if self.flights.get(key) is flight else None)
+        flight.priority.follow(spotify_call_priority.get())
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)  # one waiter being cancelled shouldnt cancel it for the others
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    @staticmethod
+    async def _run_at(priority: CallPriority, work: Callable[[], Awaitable]):
+        spotify_call_priority.set(priority)  # only affects the flight task's copy of the context
+        return await work()
@@ -0,0 +1,196 @@
+import os
+import asyncio
+from datetime import datetime, timedelta
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+import httpx
+import pytz
+from fastapi import HTTPException
+from .config import settings
+from .rate_limiter import CallPriority, RateLimiter, spotify_call_priority
+from .response_cache import ResponseCache
+
+# Environment variables for client ID and secret
+CLIENT_ID = os.getenv("SLW_SPOTIFY_ID")
+CLIENT_SECRET = os.getenv("SLW_SPOTIFY_SECRET")
+
+# Spotify URLs
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+SPOTIFY_API_BASE_URL = "https://api.spotify.com/v1"
+ARTIST_URL = f"{SPOTIFY_API_BASE_URL}/artists"
+SEARCH_URL = f"{SPOTIFY_API_BASE_URL}/search"
+
+# Global variables
+access_token = None
+expiry_time = -1
+spotify_rate_limiter = RateLimiter(settings.spotify_rate_limit, settings.spotify_rate_window, settings.spotify_rate_burst)
+
+http_client: httpx.AsyncClient = None  # shared keep-alive pool, created lazily inside the running event loop
+token_lock = asyncio.Lock()  # stops concurrent routes all refreshing an expired token at once
+# endpoint -> {id: (future, priority of the batch fetching it)} for ids another batch is already fetching
+item_flights: Dict[str, Dict[str, Tuple[asyncio.Future, Optional[CallPriority]]]] = {}
+spotify_call_budget: ContextVar = ContextVar("spotify_call_budget", default=None)  # SearchBudget counting the calls made in this context
+FETCH_FAILED = object()  # handed to coalesced waiters when the batch they joined fails, so they fetch it themselves
+response_cache = ResponseCache(settings.response_cache_path, settings.response_cache_ttls,
+                               settings.response_cache_memory_size, settings.response_cache_disk_size)
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        limits = httpx.Limits(
+            max_connections=settings.spotify_max_connections,
+            max_keepalive_connections=settings.spotify_max_keepalive,
+            keepalive_expiry=settings.spotify_keepalive_expiry
+        )
+        http_client = httpx.AsyncClient(limits=limits, timeout=settings.spotify_timeout)
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+async def get_spotify_headers() -> Dict[str, str]:
+    headers = {
+        "Authorization": f"Bearer {await get_access_token()}",
+        "Content-Type": "application/json"
+    }
+    return headers
+
+async def get_access_token():
+    async with token_lock:
+        if access_token is None or datetime.now(pytz.utc) > expiry_time:
+            await refresh_access_token()
+    return access_token
+
+async def refresh_access_token():
+
+    print(f"Refreshing access token")
+    global access_token, expiry_time
+    response = await get_http_client().post(TOKEN_URL, data={
+        'grant_type': 'client_credentials'
+    }, auth=(CLIENT_ID, CLIENT_SECRET))
+
+    if response.status_code != 200:
+        print(response.status_code)
+        print(response.text)
+        raise HTTPException(status_code=response.status_code, detail="Error fetching access token")
+
+    data = response.json()
+    access_token = data['access_token']
+    expiry_time = datetime.now(pytz.utc) + timedelta(seconds=data['expires_in'])
+
+
+async def make_spotify_call(url: str, headers=None, params=None, priority: int = None) -> httpx.Response:
+    client = get_http_client()
+    while True:
+        await spotify_rate_limiter.acquire(priority)
+        budget = spotify_call_budget.get()
+        if budget is not None:
+            budget.api_calls += 1
+        response = await client.get(url, headers=headers or await get_spotify_headers(), params=params)
+        if response.status_code == 429:  # 429 = rate limit exceeded, shouldnt happen now the limiter paces calls
+            retry_after = int(response.headers.get("Retry-After", 1))  # 1 represents default value. shouldnt get activated
+            print(f"Rate limit exceeded. Retrying after {retry_after} seconds. | limiter wait estimate : {spotify_rate_limiter.current_wait_time():.1f}s")
+            spotify_rate_limiter.penalise(retry_after)
+        else:
+            response.raise_for_status()  # Catches other errors. cause im definately gonna run into one somehow.
+            return response
+
+def get_rate_limit_wait() -> float:
+    return spotify_rate_limiter.current_wait_time()
+
+async def fetch_concurrently(calls: List[Awaitable], on_complete: Callable[[int, int], Awaitable] = None, concurrency: int = None) -> list:
+    # Runs the calls with at most `concurrency` in flight, returning results in the original order.
+    # on_complete(completed_count, total) is awaited as each one finishes (used for websocket progress bars)
+    semaphore = asyncio.Semaphore(concurrency or settings.spotify_fetch_concurrency)
+
+    async def run(index: int, call: Awaitable):
+        try:
+            async with semaphore:
+                return index, await call
+        except asyncio.CancelledError:
+            if asyncio.iscoroutine(call):
+                call.close()  # cancelled before it got a slot, stops the "never awaited" warning
+            raise
+
+    tasks = [asyncio.create_task(run(index, call)) for index, call in enumerate(calls)]
+    results = [None] * len(tasks)
+    try:
+        for completed_count, next_done in enumerate(asyncio.as_completed(tasks), start=1):
+            index, result = await next_done
+            results[index] = result
+            if on_complete:
+                await on_complete(completed_count, len(tasks))
+    finally:
+        for task in tasks:  # one failed (or we were cancelled), dont leave the rest running in the background
+            task.cancel()
+    return results
+
+async def get_spotify_json(url: str, params=None, cache_endpoint: str = None) -> dict:
+    # make_spotify_call for plain GETs, with the parsed payload cached by full url when cache_endpoint is set
+    cache_key = f"{url}?{urlencode(sorted((params or {}).items()))}"
+    if cache_endpoint:
+        cached = await response_cache.get(cache_endpoint, cache_key)
+        if cached is not None:
+            return cached
+    data = (await make_spotify_call(url, params=params)).json()
+    if cache_endpoint:
+        response_cache.put(cache_endpoint, cache_key, data)
+    return data
+
+async def get_spotify_items_by_id(endpoint: str, ids: List[str], batch_size: int, on_complete: Callable[[int, int], Awaitable] = None) -> Dict[str, dict]:
+    # Fetches /{endpoint}?ids=... payloads (albums, artists), cached per ID so a batch only asks spotify for the IDs it is missing.
+    # IDs another route is already fetching are awaited rather than requested twice.
+    # Returns {id: payload}; ids spotify doesnt know about are left out.
+    unique_ids = list(dict.fromkeys(ids))
+    items = await response_cache.get_many(endpoint, unique_ids)
+    flights = item_flights.setdefault(endpoint, {})
+    joined_flights = {item_id: flights[item_id] for item_id in unique_ids if item_id not in items and item_id in flights}
+    missing_ids = [item_id for item_id in unique_ids if item_id not in items and item_id not in joined_flights]
+    print(f"{endpoint}: {len(items)} cached, {len(joined_flights)} already in flight, fetching {len(missing_ids)}")
+
+    items.update(await fetch_items_by_id(endpoint, missing_ids, batch_size, on_complete))
+
+    retry_ids = []
+    for item_id, (future, fetching_priority) in joined_flights.items():
+        if fetching_priority is not None:
+            fetching_priority.follow(spotify_call_priority.get())  # e.g a prefetch's batch, now a route is waiting on it
+        item = await asyncio.shield(future)
+        if item is FETCH_FAILED:
+            retry_ids.append(item_id)
+        elif item is not None:
+            items[item_id] = item
+    if retry_ids:
+        items.update(await fetch_items_by_id(endpoint, retry_ids, batch_size))
+    return items
+
+async def fetch_items_by_id(endpoint: str, ids: List[str], batch_size: int, on_complete: Callable[[int, int], Awaitable] = None) -> Dict[str, dict]:
+    # requests the ids from spotify, publishing a future per id so concurrent batches can wait on this one
+    flights = item_flights.setdefault(endpoint, {})
+    own_flights = {item_id: asyncio.get_running_loop().create_future() for item_id in ids}
+    priority = spotify_call_priority.get()
+    flights.update({item_id: (future, priority) for item_id, future in own_flights.items()})
+    fetched = {}
+    completed = False
+    try:
+        id_chunks = [ids[index:index+batch_size] for index in range(0, len(ids), batch_size)]
+        responses = await fetch_concurrently(
+            [make_spotify_call(f"{SPOTIFY_API_BASE_URL}/{endpoint}", params={"ids": ','.join(ids_chunk)}) for ids_chunk in id_chunks],
+            on_complete=on_complete
+        )
+        for response in responses:
+            for item in response.json()[endpoint]:
+                if item is not None:
+                    fetched[item['id']] = item
+        response_cache.put_many(endpoint, fetched)
+        completed = True
+    finally:
+        for item_id, future in own_flights.items():
+            if not future.done():
+                future.set_result(fetched.get(item_id) if completed else FETCH_FAILED)
+            if item_id in flights and flights[item_id][0] is future:
+                del flights[item_id]
+    return fetched
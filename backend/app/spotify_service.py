@@ -1,92 +1,22 @@
-import os
-import time
 import json
+import asyncio
 from fastapi import WebSocket
-from queue import Queue
 from datetime import datetime, timedelta
-from typing import List, Tuple
-import requests
+from typing import Awaitable, List, Optional, Tuple, Union
 import pytz
 from fastapi import HTTPException, Depends
 from .db_service import *
+from .async_db import AsyncDb
+from .spotify_client import *
+from .single_flight import SingleFlight
+from .graph_index import graph_index
+from .landmarks import landmark_table
+from .route_cache import route_cache
+from .route_search import *
+from .config import settings
 
 from .dtos import *
 
-# Environment variables for client ID and secret
-CLIENT_ID = os.getenv("SLW_SPOTIFY_ID")
-CLIENT_SECRET = os.getenv("SLW_SPOTIFY_SECRET")
-
-# Spotify URLs
-TOKEN_URL = "https://accounts.spotify.com/api/token"
-SPOTIFY_API_BASE_URL = "https://api.spotify.com/v1"
-ARTIST_URL = f"{SPOTIFY_API_BASE_URL}/artists"
-SEARCH_URL = f"{SPOTIFY_API_BASE_URL}/search"
-
-# Global variables
-access_token = None
-expiry_time = -1
-api_call_times = Queue()
-RATE_LIMIT = 90
-
-def get_spotify_headers():
-    headers = {
-        "Authorization": f"Bearer {get_access_token()}",
-        "Content-Type": "application/json"
-    }
-    return headers
-
-def get_access_token():
-    global access_token, expiry_time
-    if access_token is None or datetime.now(pytz.utc) > expiry_time:
-        refresh_access_token()
-    return access_token
-
-def refresh_access_token():
-
-    print(f"Refreshing access token")    
-    global access_token, expiry_time
-    response = requests.post(TOKEN_URL, {
-        'grant_type': 'client_credentials'
-    }, auth=(CLIENT_ID, CLIENT_SECRET))
-
-    if response.status_code != 200:
-        print(response.status_code)
-        print(response.text)
-        raise HTTPException(status_code=response.status_code, detail="Error fetching access token")
-
-    data = response.json()
-    access_token = data['access_token']
-    expiry_time = datetime.now(pytz.utc) + timedelta(seconds=data['expires_in'])
-
-
-def check_rate_limit() -> Tuple[bool, int]: # returns if the call is expected to work and the ammount in the rolling window
-    global api_call_times
-    now = datetime.now(pytz.utc).timestamp()
-    
-    # Remove timestamps older than 30 seconds
-    while not api_call_times.empty() and now - api_call_times.queue[0] > 30:
-        api_call_times.get()
-
-    # Check if within rate limit
-    if api_call_times.qsize() < RATE_LIMIT:
-        api_call_times.put(now)
-        return (True, api_call_times.qsize())
-    return (False, api_call_times.qsize())
-
-
-def make_spotify_call(url: str, headers, params=None):
-    while True:
-        call_result : Tuple[bool, int] = check_rate_limit()
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 429:  # 429 = rate limit exceeded.
-            retry_after = int(response.headers.get("Retry-After", 1))  # 1 represents default value. shouldnt get activated
-            # print(f"Rate limit exceeded. Retrying after {retry_after} seconds. | rolling calls : {call_result[1]}, expected outcome was : {'True' if call_result[0] else 'False'}")
-            time.sleep(retry_after)
-        else:
-            response.raise_for_status()  # Catches other errors. cause im definately gonna run into one somehow.
-            # print(f"Call successful. | rolling calls : {call_result[1]}, expected outcome was : {"True" if call_result[0] else "False"}") 
-            return response
-
 # DEPRECATED due to adjustments to image storage.
 # def select_profile_picture(images: List[Image]) -> str:#
 #     for image in images:
@@ -101,12 +31,11 @@ def select_profile_picture(images: List[Dict]) -> str:
             return image.url
     return image_objects[0].url if image_objects else "default"
 
-def get_artist(artist_name: str, max_results: int) -> List[Artist]:
+async def get_artist(artist_name: str, max_results: int) -> List[Artist]:
 
     artist_name = artist_name.strip().replace(' ', '+')
     url = f"{SEARCH_URL}?q={artist_name}&type=artist&limit={max_results}"
-    headers = get_spotify_headers()
-    response = make_spotify_call(url, headers)
+    response = await make_spotify_call(url)
 
     data = response.json()
     artist_search_response = ArtistSearchResponse(**data)
@@ -131,80 +60,102 @@ def get_artist(artist_name: str, max_results: int) -> List[Artist]:
 
 async def get_artist_albums(spotify_id: str, all_albums: bool = False, ws_connection=None) -> List[Album]:
 
-    url = f"{ARTIST_URL}/{spotify_id}/albums"
-    headers = get_spotify_headers()
-    params = {"limit": 50, "offset": 0, "include_groups": "single,appears_on,album"}
-    album_ids = []
-    total_albums = None
+    album_ids = await get_artist_album_ids(spotify_id, all_albums, ws_connection=ws_connection)
+    detailed_albums = await get_detailed_album_info(album_ids, ws_connection=ws_connection)
+    return detailed_albums
 
-    while True:
-        print(f"Finding albums {params['offset']} - {params['offset'] + params['limit']}")
-        if ws_connection:
-            progress_bar = (params['offset']/total_albums) * 100 if total_albums else None
-            await send_status_update(ws_connection, 
-                                     f"Collating albums {params['offset']} - {params['offset'] + params['limit']}", progress_bar=progress_bar)
-        response = make_spotify_call(url, headers, params)
+async def get_artist_album_ids(spotify_id: str, all_albums: bool = False, ws_connection=None, crawl_policy: CrawlPolicy = None) -> List[str]:
+    # crawl_policy filters out albums that shouldnt count as collaborations (e.g compilations), None keeps everything
 
-        data = response.json()
-        print(f"total albums = {data['total']}")
-        total_albums = data['total']
-        album_ids.extend([item['id'] for item in data['items']])
+    url = f"{ARTIST_URL}/{spotify_id}/albums"
+    page_size = 50
+    include_groups = crawl_policy.include_groups if crawl_policy else "single,appears_on,album"
+    params = {"limit": page_size, "offset": 0, "include_groups": include_groups}
 
-        if not all_albums or len(data['items']) < 50:
-            break
+    # First page tells us the total, the rest of the pages can then be requested together.
+    print(f"Finding albums 0 - {page_size}")
+    if ws_connection:
+        await send_status_update(ws_connection, f"Collating albums 0 - {page_size}")
+    data = await get_spotify_json(url, params=params, cache_endpoint="artist_albums")
+    total_albums = data['total']
+    print(f"total albums = {total_albums}")
+    album_items = list(data['items'])  # a copy, data is the cached payload and mustnt be changed
+
+    if all_albums and len(data['items']) == page_size:
+        offsets = list(range(page_size, total_albums, page_size))
+
+        async def on_page_complete(completed_count, page_count):
+            if ws_connection:
+                progress_bar = (completed_count + 1) / (page_count + 1) * 100
+                await send_status_update(ws_connection,
+                                         f"Collating albums ({(completed_count + 1) * page_size} / {total_albums})", progress_bar=progress_bar)
+
+        pages = await fetch_concurrently(
+            [get_spotify_json(url, params={**params, "offset": offset}, cache_endpoint="artist_albums") for offset in offsets],
+            on_complete=on_page_complete
+        )
+        for page in pages:
+            album_items.extend(page['items'])
 
-        params['offset'] += 50
+    album_ids = [item['id'] for item in album_items if not crawl_policy or crawl_policy.accepts_album(item)]
+    print(f"album_ids length = {len(set(album_ids))} ({len(album_items) - len(album_ids)} skipped by crawl policy)")
+    return album_ids
 
-    # Fetch detailed information for all albums
-    print(f"album_ids length = {len(set(album_ids))}")
-    
-    detailed_albums = await get_detailed_album_info(album_ids, ws_connection=ws_connection)
-    return detailed_albums
+async def get_album_payloads(album_ids: List[str], ws_connection=None) -> Dict[str, dict]:
 
-async def get_detailed_album_info(album_ids: List[str], ws_connection=None) -> List[Album]:
-    
-    headers = get_spotify_headers()
-    all_albums = []
+    # Albums come back in chunks of 20 (max the multiple albums API can handle), already cached ones are skipped
+    print(f"Fetching detailed album information for {len(album_ids)} albums")
+
+    async def on_chunk_complete(completed_count, chunk_count):
+        if ws_connection:
+            progress_bar = completed_count / chunk_count * 100
+            await send_status_update(ws_connection,
+                                     f"Fetching Detailed Album Information (batch {completed_count} / {chunk_count})", progress_bar=progress_bar)
 
-    # Calculate the number of iterations needed to process all album IDs in chunks of 20 (max the multiple albums API can handle)
-    iteration_count = (len(album_ids) + 19) // 20  # Ceiling division
+    return await get_spotify_items_by_id("albums", album_ids, 20, on_complete=on_chunk_complete)
 
-    for index in range(iteration_count):
-        # Slice the album_ids list to get a chunk of up to 20 IDs
-        ids_chunk = album_ids[index*20:(index+1)*20]
-        ids_param = ','.join(ids_chunk)
-        url = f"{SPOTIFY_API_BASE_URL}/albums?ids={ids_param}"
+async def get_detailed_album_info(album_ids: List[str], ws_connection=None) -> List[Album]:
 
-        
-        print(f"Fetching detailed album information for albums {index*20} -> {(index+1)*20}. Total Albums: {len(album_ids)}")
-        if ws_connection:
-            progress_bar = index*20 / len(album_ids) * 100
-            await send_status_update(ws_connection, 
-                                     f"Fetching Detailed Album Information for albums {index*20} -> {(index+1)*20 if (index+1)*20 < len(album_ids) else len(album_ids)} / {len(album_ids)}", progress_bar=progress_bar)
-        response = make_spotify_call(url, headers)
-        if response.status_code != 200:
-            try:
-                detail = response.json()
-            except requests.exceptions.JSONDecodeError:
-                detail = response.text
-            raise HTTPException(status_code=response.status_code, detail=detail)
-
-        data = response.json()
-        for album_data in data['albums']:
-            if 'tracks' in album_data:
-                for track_data in album_data['tracks']['items']:
-                    missing_fields = [field for field in ['href', 'id', 'name', 'preview_url'] if field not in track_data]
-                    if 'artists' in track_data:
-                        track_data['artists'] = [TrackArtist(**artist) for artist in track_data['artists']]
-                    track_data['preview_url'] = track_data.get('preview_url', None) # wierd issue arose where suddenly this missing was an issue, so had to use .get like the other 2.
-                    track_data['is_playable'] = track_data.get('is_playable', None)
-                    track_data['popularity'] = track_data.get('popularity', None)
-                album_data['tracks'] = AlbumTracks(**album_data['tracks'])
-            album = Album(**album_data)
-            all_albums.append(album)
+    album_data_by_id = await get_album_payloads(album_ids, ws_connection=ws_connection)
 
+    # payloads are shared with the response cache so are validated as-is rather than patched in place
+    all_albums = [Album.model_validate(album_data_by_id[album_id]) for album_id in dict.fromkeys(album_ids) if album_id in album_data_by_id]
     return all_albums
 
+async def get_album_track_artists(album_ids: List[str], ws_connection=None) -> List[List[TrackArtists]]:
+    # Fast path for connection crawls, only the artist (id, name) pairs of each track are kept (one list per album).
+    # Skips building the full Album models (markets, images, urls...) that get_detailed_album_info validates.
+    album_data_by_id = await get_album_payloads(album_ids, ws_connection=ws_connection)
+    album_track_artists = []
+    for album_id in dict.fromkeys(album_ids):
+        album_data = album_data_by_id.get(album_id)
+        if album_data is not None:
+            album_track_artists.append(extract_track_artists(album_data))
+    return album_track_artists
+
+def extract_track_artists(album_data: dict) -> List[TrackArtists]:
+    tracks = (album_data.get('tracks') or {}).get('items') or []
+    return [tuple((artist['id'], artist['name']) for artist in track.get('artists', []) if artist.get('id'))
+            for track in tracks]
+
+def get_artists_from_track_artists(album_track_artists: List[List[TrackArtists]], original_artist: Artist, crawl_policy: CrawlPolicy = DEFAULT_CRAWL_POLICY) -> List[Artist]:
+    unique_artists: Dict[str, Artist] = {}
+
+    for album_tracks in album_track_artists:
+        taken_from_album = 0
+        for track in album_tracks:
+            if crawl_policy.credited_tracks_only and not any(artist_id == original_artist.id for artist_id, _ in track):
+                continue
+            for artist_id, artist_name in track:
+                if artist_id == original_artist.id or artist_id in unique_artists:
+                    continue
+                if crawl_policy.max_artists_per_album is not None and taken_from_album >= crawl_policy.max_artists_per_album:
+                    break
+                unique_artists[artist_id] = Artist.from_track_artist_ref(artist_id, artist_name)
+                taken_from_album += 1
+
+    return list(unique_artists.values())
+
 def get_artists_from_album_list(albums: List[Album], original_artist: Artist) -> List[Artist]:
     unique_artists = set()
 
@@ -221,24 +172,51 @@ def get_artists_from_album_list(albums: List[Album], original_artist: Artist) ->
     return list(unique_artists)
 
 
-async def get_connections(artist: Artist, db : Session = None, ws_connection = None) -> Artist:
+connection_crawls = SingleFlight()  # artist id -> in progress album crawl, shared by every route
+
+async def get_connections(artist: Artist, db: AsyncDb = None, ws_connection = None, crawl_policy: CrawlPolicy = None) -> Artist:
     print(f"Finding connections for {artist.name}")
+    crawl_policy = crawl_policy or DEFAULT_CRAWL_POLICY
+    requested_artist = artist  # the callers object, gets tagged with the policy its connections came from
+    indexed = graph_index.get_cached_connections(artist.id)
+    if indexed is not None:
+        indexed_connections, indexed_policy = indexed
+        # rows from before crawl policies existed (None) were crawled with everything included, so are still usable
+        if len(indexed_connections) > 2 and (indexed_policy is None or indexed_policy == crawl_policy.key()):
+            print(f"Using Graph Index Cached Connections ({len(indexed_connections)})")
+            if ws_connection:
+                await send_status_update(ws_connection, f"Importing Cached Collaborations for {artist.name}")
+            requested_artist.crawlPolicy = indexed_policy
+            return indexed_connections
     if db:
         print(f"Checking db for up-to-date artist entry")
-        artist = update_artist_with_db(db, artist, require_all_connections=True)
+        artist = await db.update_artist_with_db(artist, require_all_connections=True)
     print(f"get_connections | connections length for {artist.name} : {len(artist.connections)}")
-    if len(artist.connections) > 2: # and artist.lastUpdated.astimezone(pytz.utc) > datetime.now(pytz.utc) - timedelta(days=7) --> Add back in once lastUpdated is fixed
+    # rows from before crawl policies existed (None) were crawled with everything included, so are still usable
+    cached_policy_usable = artist.crawlPolicy is None or artist.crawlPolicy == crawl_policy.key()
+    if len(artist.connections) > 2 and cached_policy_usable: # and artist.lastUpdated.astimezone(pytz.utc) > datetime.now(pytz.utc) - timedelta(days=7) --> Add back in once lastUpdated is fixed
         print(f"Using Database Cached Connections")
         if ws_connection:
             await send_status_update(ws_connection, f"Importing Cached Collaborations for {artist.name}")
+        requested_artist.crawlPolicy = artist.crawlPolicy
         return artist.connections
-    albums = await get_artist_albums(artist.id, all_albums=True, ws_connection=ws_connection)
+    crawl_key = (artist.id, crawl_policy.key())
+    if connection_crawls.is_in_flight(crawl_key) and ws_connection:
+        await send_status_update(ws_connection, f"Waiting on another route's crawl of {artist.name}")
     artist.lastUpdated = datetime.now(pytz.utc)
-    artist_list = get_artists_from_album_list(albums, artist)
-    if artist_list is not None:
-        return await get_multiple_artists(artist_list, ws_connection=ws_connection)
-    else:
+    connections = await connection_crawls.run(crawl_key, lambda: crawl_connections(artist, ws_connection, crawl_policy))
+    if connections is None:
         return None
+    requested_artist.crawlPolicy = crawl_policy.key()
+    # every caller of a shared crawl gets its own copies, routes go on to mutate them
+    return [connection.model_copy() for connection in connections]
+
+async def crawl_connections(artist: Artist, ws_connection = None, crawl_policy: CrawlPolicy = DEFAULT_CRAWL_POLICY) -> List[Artist]:
+    # progress updates only go to the route that started the crawl, any coalesced callers just wait on the result
+    album_ids = await get_artist_album_ids(artist.id, all_albums=True, ws_connection=ws_connection, crawl_policy=crawl_policy)
+    album_track_artists = await get_album_track_artists(album_ids, ws_connection=ws_connection)
+    artist_list = get_artists_from_track_artists(album_track_artists, artist, crawl_policy)
+    return await get_multiple_artists(artist_list, ws_connection=ws_connection)
 
 def contains_artist(artist_list : List[Artist], artist : Artist):
     for a in artist_list:
@@ -249,50 +227,33 @@ def contains_artist(artist_list : List[Artist], artist : Artist):
 async def get_multiple_artists(artist_list: List[Artist], ws_connection = None) -> List[Artist]:
     
     artist_ids = [artist.id for artist in artist_list]
-    headers = get_spotify_headers()
-    all_artists = []
 
     # Fetch in chunks of 50 (the maximum number of artists that can be fetched at once)
     # Need to see why the profile picture grabbing on this part doesnt work, (see gpt output for whats technically causing it)
     print(f"number of artists to get information on : {len(artist_ids)}")
-    for i in range(0, len(artist_ids), 50):
-        ids_chunk = artist_ids[i:i+50]
-        end_artist_name = artist_list[i+50].name if i + 50 < len(artist_list) else artist_list[-1].name
-        print(f"Fetching Detailed Artist Information for artists {i} ({(artist_list[i].name)}) -> {i+50} ({end_artist_name})")
+
+    async def on_chunk_complete(completed_count, chunk_count):
         if ws_connection:
-            progress_bar = i / len(artist_ids)*100
-            await send_status_update(ws_connection, f"Fetching Detailed Artist Information for artists {i} -> {i+50}", progress_bar=progress_bar)
-        ids_param = ','.join(ids_chunk)
-        url = f"{SPOTIFY_API_BASE_URL}/artists?ids={ids_param}"
-        response = make_spotify_call(url, headers=headers)
-
-        data = response.json()
-        for item in data['artists']:
-            profile_picture_url = select_profile_picture(item['images'])
-            updated_artist = Artist(
-                id=item['id'],
-                artURL=profile_picture_url,
-                followers=item['followers']['total'],
-                name=item['name'],
-                popularity=item['popularity'],
-                lastUpdated=None,
-                connections=[],  # does not get obtained through this anyway, so isnt even used below 
-                genres=item.get('genres', [])
-            )
-            all_artists.append(updated_artist)
+            progress_bar = completed_count / chunk_count * 100
+            await send_status_update(ws_connection, f"Fetching Detailed Artist Information (batch {completed_count} / {chunk_count})", progress_bar=progress_bar)
+
+    artist_data_by_id = await get_spotify_items_by_id("artists", artist_ids, 50, on_complete=on_chunk_complete)
+
     # Update the original artist list with the new details
-    for old_artist, new_artist in zip(artist_list, all_artists):
-        old_artist.artURL = new_artist.artURL
-        old_artist.followers = new_artist.followers
-        old_artist.popularity = new_artist.popularity
-        old_artist.genres = new_artist.genres
+    for old_artist in artist_list:
+        item = artist_data_by_id.get(old_artist.id)
+        if item is None:
+            continue
+        old_artist.artURL = select_profile_picture(item['images'])
+        old_artist.followers = item['followers']['total']
+        old_artist.popularity = item['popularity']
+        old_artist.genres = item.get('genres', [])
     return artist_list
 
 # just made for utility, not currently used
-def get_single_artist(artist: Artist) -> Artist:
+async def get_single_artist(artist: Artist) -> Artist:
     url = f"{SPOTIFY_API_BASE_URL}/artists/{artist.id}"
-    headers = get_spotify_headers()
-    response = make_spotify_call(url, headers)
+    response = await make_spotify_call(url)
 
     item = response.json()
     profile_picture_url = select_profile_picture(item['images'])
@@ -304,11 +265,10 @@ def get_single_artist(artist: Artist) -> Artist:
     return artist
 
 # just made for utility, not currently used 
-def get_single_artist_by_id(artist_id: str) -> Artist:
+async def get_single_artist_by_id(artist_id: str) -> Artist:
     
     url = f"{SPOTIFY_API_BASE_URL}/artists/{artist_id}"
-    headers = get_spotify_headers()
-    response = make_spotify_call(url, headers)
+    response = await make_spotify_call(url)
     item = response.json()
     profile_picture_url = select_profile_picture(item['images'])
     artist = Artist(
@@ -326,63 +286,6 @@ def get_single_artist_by_id(artist_id: str) -> Artist:
     return artist
 
 
-def sort_by_weight(unchecked_artists : List[Tuple[Artist, int, int, List[Artist]]], target_artist : Artist) -> List[Tuple[Artist, int, int]]:
-    
-    # Order by how many genres they share, and account for both popularity (higher the better) and their integer (lower is better)
-    updated_artist_list = []
-    # print(f"unchecked_artists[0] = {unchecked_artists[0]}")
-    for artist, depth, weight, previous_connections in unchecked_artists:
-        if weight == -1:
-            # Calculates weight 
-            weight = calculate_weight(artist, target_artist, depth)
-        updated_artist_list.append((artist, depth, weight, previous_connections))
-
-    # Sort by depth first (second element in tuple) and then by weight (third element in tuple)
-    # TODO: This doesnt work, 
-    sorted_artist_list = sorted(updated_artist_list, key=lambda x: (x[2], x[1], x[0].popularity))
-
-    return sorted_artist_list
-
-def calculate_weight(selected_artist : Artist, target_artist : Artist, depth : int) -> int:
-    
-    # calculate a weight, representing how likely (as a guess) they are to lead to the target artist. 
-    # should be calculated as a number representing 
-    # 1. how many genres they share (max 1 for if selectedArtist contains all genres of the targetArtist)
-    # 2. their popularity score (scaling from 0.75 to 1 based on their popularity)
-    # 3. depth from the starting artist (reducing by 0.15 for each depth (hoping that the six degrees of seperation applies and no more than 5 is ever needed))
-    selected_genres = set(selected_artist.genres or [])
-    target_genres = set(target_artist.genres or [])
-    
-    # Calculate shared genres weight
-    if target_genres & selected_genres:
-        shared_genres_ratio = len(selected_genres.intersection(target_genres)) / len(target_genres)
-    elif target_genres:
-        shared_genres_ratio = 0.75 # random value really, just so it has an effect, normally no genres probably means low popularity too. 
-    else:
-        shared_genres_ratio = 1 # due to target not having any genres, will not be relevant in calcuation. 
-    popularity_weight = 0.75 + (0.25 * (selected_artist.popularity / 100))
-    depth_penalty = max(0, 1 - (0.15 * depth))
-    answer = shared_genres_ratio * popularity_weight * depth_penalty
-    return answer
-
-def check_if_complete(current_artist : Artist, checked_artists: List[Tuple[Artist, bool]], target_artist: Artist) -> List[Artist]:
-    checked_artist_ids = {artist.id for artist, isConnectedToTarget in checked_artists if isConnectedToTarget}
-    # print(f"current_artist.connections = {current_artist.connections}")
-    for connection in current_artist.connections:
-        # print(f"Checking if {connection.name} -> {target_artist.name}")
-
-        if connection.id == target_artist.id:
-            print(f"returning [{current_artist.name}, {target_artist.name}]")
-            return [current_artist, target_artist]
-
-        if connection.id in checked_artist_ids:
-            print(f"returning [{current_artist.name}, {connection.name}, {target_artist.name}]")
-            return [current_artist, connection, target_artist]
-
-    print(f"appending [{current_artist.name}, False] to checked_artists.")
-    checked_artists.append((current_artist, False))
-    return []
-
 def remove_connections(artist_list : List[Artist]) -> List[Artist]:
     for artist in artist_list:
         artist.connections = None
@@ -396,6 +299,8 @@ async def send_route_update(ws_connection, graph_manager: GraphManager, display_
     graph_manager.add_artist(new_artist, current_depth)
     
     changes = graph_manager.get_changes()
+    if ws_connection is None:
+        return
     if send_full_graph:
         full_graph = graph_manager.get_graph()
         await ws_connection.send_text(json.dumps({"update_type": update_type,
@@ -417,181 +322,295 @@ async def set_selected_artist(ws_connection, selected_artist: Artist, graph_mana
     if send_full_graph:
         graph_manager.set_selected_artist(selected_artist)
         graph = graph_manager.get_graph()
+        if ws_connection is None:
+            return
         await ws_connection.send_text(json.dumps({"update_type": "selection", 
                                               "message": f"Gathering collaborations : {selected_artist.name}", 
                                               "graph": graph.to_dict(),
                                               "full_graph": True}))
-    else:
+    elif ws_connection is not None:
         await ws_connection.send_text(json.dumps({"update_type": "selection", 
                                               "message": f"Gathering collaborations : {selected_artist.name}", 
                                               "selected_artist": selected_artist.id,
                                               "full_graph": False}))
 
 async def send_status_update(ws_connection, display_message: str, secondary_message: str = None, progress_bar: int = None): 
+    if ws_connection is None:
+        return
     await ws_connection.send_text(json.dumps({"update_type": "status",
                                               "message": display_message,
                                               "progress": progress_bar}))
 
+class BestEffortResult(BaseModel):
+    # what a search that ran out of budget got to, instead of a route
+    reason: str  # which limit ran out: time, expansions or api_calls
+    closest_artist: Optional[Artist] = None  # the artist the search would have expanded next (from the starting side if it can)
+    depth_reached: int  # deepest expansion from the starting side + from the ending side
+    budget_used: Dict[str, Union[int, float]]  # elapsed_seconds, expansions, api_calls
+
 class RouteReply(BaseModel):
     route_list: List[Artist]
     graph: Optional[GraphStructure] = None
+    alternative_routes: List[List[Artist]] = []  # next best distinct routes, shortest first (only when asked for)
+    alternatives_proven: bool = True  # False when the search stopped on its allowance, the alternatives are the best it found
+    best_effort: Optional[BestEffortResult] = None  # set when the search budget ran out before a route was found
     
-async def find_route(starting_artist: Artist, ending_artist: Artist, ws_connection: WebSocket, db : Session = None, send_full_graph=True) -> RouteReply:
-    # base case. 
-    # To disable DB entry can just pass db as None
+async def find_cached_route(starting_artist: Artist, ending_artist: Artist, ws_connection: WebSocket = None, send_full_graph=True) -> Optional[RouteReply]:
+    # Answers the route purely from the in-memory graph index (no spotify calls, no db queries).
+    # None means the stored graph doesnt connect them through fully crawled artists yet, so a live search is needed.
+    # off the loop, a lookup over a big stored graph can take a while
+    route_ids = await asyncio.to_thread(graph_index.find_path, starting_artist.id, ending_artist.id, max_visited=settings.cached_route_max_visited)
+    if route_ids is None:
+        return None
+    route_list = [starting_artist if artist_id == starting_artist.id else ending_artist if artist_id == ending_artist.id else graph_index.get_artist(artist_id)
+                  for artist_id in route_ids]
+    print(f"Cached route found: [{', '.join([artist.name for artist in route_list])}]")
+
+    graph = build_route_graph(route_list) if send_full_graph else None
+    await send_status_update(ws_connection, f"Route found in cached collaborations: {starting_artist.name} -> {ending_artist.name}")
+    return RouteReply(route_list=route_list, graph=graph)
+
+def build_route_graph(route_list: List[Artist]) -> GraphStructure:
+    # graph of just the route itself, so the frontend has something to draw when no search was run
+    graph_manager: GraphManager = GraphManager()
+    for depth, artist in enumerate(route_list):
+        route_neighbours = route_list[max(depth - 1, 0):depth] + route_list[depth + 1:depth + 2]
+        graph_manager.add_artist(artist.model_copy(update={"connections": route_neighbours}), depth)
+    for artist, next_artist in zip(route_list, route_list[1:]):
+        graph_manager.full_graph.add_connection(artist, next_artist)  # add_artist skips artists with a single connection
+    graph_manager.finalise_graph(route_list[-1], route_list)
+    return graph_manager.get_graph()
+
+async def find_recent_route(starting_artist: Artist, ending_artist: Artist, ws_connection: WebSocket = None, send_full_graph=True) -> Optional[RouteReply]:
+    # A route found by an earlier request for the same pair (either direction), see route_cache.py. None on a miss.
+    cached_route = route_cache.get(starting_artist.id, ending_artist.id)
+    if cached_route is None:
+        return None
+    route_list = [starting_artist] + [artist.model_copy() for artist in cached_route.route_list[1:-1]] + [ending_artist]
+    graph = None
+    if send_full_graph:
+        graph = cached_route.graph.model_copy(deep=True) if cached_route.graph is not None else build_route_graph(route_list)
+    print(f"Recent route found: [{', '.join([artist.name for artist in route_list])}]")
+    await send_status_update(ws_connection, f"Route found in recent searches: {starting_artist.name} -> {ending_artist.name}")
+    return RouteReply(route_list=route_list, graph=graph)
+
+def remember_route(route_reply: RouteReply):
+    route_cache.put(route_reply.route_list, route_reply.graph if settings.route_cache_store_graph else None)
+
+async def find_route(starting_artist: Artist, ending_artist: Artist, ws_connection: WebSocket, db: AsyncDb = None, send_full_graph=True, crawl_policy: CrawlPolicy = None, prefetch_count: int = None, use_landmarks=True,
+                     connection_cache: Dict[str, List[Artist]] = None, budget: SearchBudget = None, route_count: int = 1) -> RouteReply:
+    # Bidirectional best-first search: one side grows from each end, each turn expanding the side with the smaller
+    # frontier, until an expanded artist's connections touch something the other side has already discovered.
+    # If the landmark tables know the target a side runs as A* (see landmarks.py), otherwise it goes on weight alone.
+    # To disable DB entry can just pass db as None. prefetch_count defaults to settings.route_prefetch_count (0 disables)
+    # budget caps the search's time / expansions / spotify calls, running out gives a RouteReply with best_effort set.
+    # connection_cache (artist id -> connections) and budget can be shared between searches, see find_routes_batch.
+    # route_count > 1 keeps the search going after the first meeting (for at most settings.route_alternative_expansions
+    # more expansions per extra route), returning the best others as alternative_routes.
     if starting_artist.id == ending_artist.id: 
-        return RouteReply([starting_artist], graph=None)
-        
-    found = False
-    artist_route = [] # return value 
-    starting_artist = starting_artist
-    checked_artists: List[Tuple[Artist, bool]] = []
-    unchecked_artists: List[Tuple[Artist, int, int, List[Artist]]] = [] # Artist, depth from starting artist, calculated weight, previous connections
+        return RouteReply(route_list=[starting_artist], graph=None)
+
     graph_manager: GraphManager = GraphManager()
-    
-    flipped_artists = False
-    flipped_artist_str = ""
-    if starting_artist.popularity > ending_artist.popularity:
-        starting_artist, ending_artist = ending_artist, starting_artist
-        flipped_artists = True
-        flipped_artist_str = "Flipped order due to starting artist being more popular, so easier to find"
-        # switches round as starting artist is more popular so will be easier to reach from ending artist as a start.
-        
-    if ws_connection:
-        await send_route_update(ws_connection, graph_manager, f"Starting route finding: {starting_artist.name} -> {ending_artist.name} (" + flipped_artist_str + ") ",  starting_artist, 0, overrideUpdateType="start", send_full_graph=send_full_graph)
+    forward_heuristic = landmark_table.heuristic_to(graph_index, ending_artist.id) if use_landmarks else None
+    backward_heuristic = landmark_table.heuristic_to(graph_index, starting_artist.id) if use_landmarks else None
+    forward_side = SearchSide(starting_artist, ending_artist, is_forward=True, heuristic=forward_heuristic)
+    backward_side = SearchSide(ending_artist, starting_artist, is_forward=False, heuristic=backward_heuristic)
+    prefetch_count = settings.route_prefetch_count if prefetch_count is None else prefetch_count
+
+    async def fetch_connections(artist: Artist, ws=None) -> List[Artist]:
+        if connection_cache is not None and artist.id in connection_cache:
+            return [connection.model_copy() for connection in connection_cache[artist.id]]
+        return await get_connections(artist, db, ws_connection=ws, crawl_policy=crawl_policy) or []
+
+    prefetcher = Prefetcher(fetch_connections, prefetch_count)
+
+    def choose_side() -> Optional[SearchSide]:
+        # the side with the smaller (cheaper) frontier, None once both have run dry
+        if not forward_side.has_frontier() and not backward_side.has_frontier():
+            return None
+        if not backward_side.has_frontier() or (forward_side.has_frontier() and forward_side.frontier_size() <= backward_side.frontier_size()):
+            return forward_side
+        return backward_side
+
+    async def expand(side: SearchSide, artist: Artist, depth: int) -> Optional[List[ArtistRecord]]:
+        # gets the connections for the artist, adds them to the graph + frontier and returns the route if the sides met.
+        # The connections are only held for this call, the search itself just keeps records + parent ids.
+        already_saved = connection_cache is not None and artist.id in connection_cache  # a search sharing the cache already expanded (and saved) it
+        prefetched_artist = await prefetcher.take(artist.id)
+        if prefetched_artist is not None:
+            artist = prefetched_artist
+        else:
+            artist.connections = await fetch_connections(artist, ws_connection)
+        artist.lastUpdated = datetime.now(pytz.utc)
+        other_side = backward_side if side.is_forward else forward_side
+        # the graph shows the ending artists half at negative depths
+        await send_route_update(ws_connection, graph_manager, f"Connections for {artist.name} added", artist, depth if side.is_forward else -1, send_full_graph=send_full_graph)
+        if not already_saved:
+            if db:
+                await db.save_artist(artist)
+            if connection_cache is not None:
+                connection_cache[artist.id] = artist.connections
+        routes = side.find_meetings(artist.id, artist.connections, other_side)
+        side.expand(artist.id, artist.connections)
+        return routes
+
+    found_routes: Dict[Tuple[str, ...], List[ArtistRecord]] = {}  # distinct routes so far, keyed by their artist ids
+    # expansions the search may spend looking for alternatives once it has its first route
+    alternative_expansions_left = settings.route_alternative_expansions * (route_count - 1)
+    alternatives_proven = True
+
+    def routes_proven(routes: List[List[ArtistRecord]]) -> bool:
+        # Adds the routes from the last expansion and says whether the search can stop.
+        # Any route found later has to go through an artist still queued on one of the sides, so it is at least one
+        # collaboration longer than the shallowest queued artist. Once route_count routes are no longer than that
+        # nothing shorter can turn up (routes of equal length can, but they are only ordered by weight).
+        # That bound only gets there once both sides have emptied their shallow levels, which for well connected ends
+        # means crawling most of their collaborators, so past the first route the search only gets
+        # alternative_expansions_left more expansions. Stopping on those leaves the alternatives best found, not proven.
+        nonlocal alternative_expansions_left, alternatives_proven
+        had_route = bool(found_routes)
+        for route in routes:
+            found_routes.setdefault(tuple(record.id for record in route), route)
+        if not found_routes:
+            return False
+        if route_count == 1:
+            return True
+        if len(found_routes) >= route_count:
+            queued_depths = [side.frontier.min_depth() for side in (forward_side, backward_side) if side.has_frontier()]
+            if not queued_depths:
+                return True
+            shortest_possible = min(queued_depths) + 1
+            if sum(1 for route in found_routes.values() if len(route) - 1 <= shortest_possible) >= route_count:
+                return True
+        if had_route:
+            alternative_expansions_left -= 1
+        if alternative_expansions_left <= 0:
+            print(f"Alternative route allowance used up with {len(found_routes)} routes found, returning the best of them")
+            alternatives_proven = False
+            return True
+        return False
 
-    # 1. Get all related artists for the first artist. 
-    
-    starting_artist.connections = await get_connections(starting_artist, db, ws_connection=ws_connection)
-    print(f"Artists connecting to {starting_artist.name} \n")
-    await send_route_update(ws_connection, graph_manager, f"Connections for {starting_artist.name} added. ", starting_artist, 0, send_full_graph=send_full_graph)
-    for artist in starting_artist.connections: 
-        # print(f"artist.name = {artist.name}, ending_artist.name = {ending_artist.name}")
-        if artist.id == ending_artist.id:
-            found = True
-            
-    await set_selected_artist(ws_connection, ending_artist, graph_manager=graph_manager)
-    ending_artist.connections = await get_connections(ending_artist, db, ws_connection=ws_connection)
-    save_artist(db, ending_artist)
-    print(f"Artists connecting to {ending_artist.name} \n")
-    for artist in ending_artist.connections:
-        checked_artists.append((artist, True))
-        # print(f"Artist number {count}: {artist.name} \n")
-    await send_route_update(ws_connection, graph_manager, f"Connections for {ending_artist.name} added. ", ending_artist, -1, send_full_graph=send_full_graph)
-        
-    # starting_artist.connections = get_multiple_artists(starting_artist.connections) -> moved this into get_connections, shouldnt be needed anymore
-    for artist in starting_artist.connections:
-        # Due to immutability of tuples, needs to be ran here, the get_multiple_artists call is made here as its more efficient purely on spotify api calls, not overall runtime. (as if the connection is directly from starting_artist then the extra information is not required)
-        # due to get_multiple_artists being relocated inside get_connections, i believe this can be moved to the first starting_artist.connections for loop, but if it aint broke dont fix it sort of logic applies here as of this comment.
-        unchecked_artists.append((artist, 1, -1, [starting_artist]))
-    if db:
-        save_artist(db, starting_artist)
-    if found:
-        route_list = [ending_artist, starting_artist] if flipped_artists else [starting_artist, ending_artist]
-        await send_route_update(ws_connection, graph_manager, f"Route Complete: {starting_artist.name} -> {ending_artist.name}. Found in 1 link.", ending_artist, 1, send_full_graph=send_full_graph)
-        graph_manager.finalise_graph(ending_artist, route_list)
-        route_reply = RouteReply(
-        route_list=route_list,
-        graph=graph_manager.get_graph() if send_full_graph else None
-        )
-        return route_reply
-    
-    potential_end = check_if_complete(starting_artist, checked_artists, ending_artist)
-    if potential_end != []:
-        # to check if target_artist or connecting artist is used
-        required_connecting_artist = len(potential_end) > 2
-        if required_connecting_artist:
-            potential_end[1].connections = await get_connections(potential_end[1], db, ws_connection=ws_connection)
-            # Fixes inconsistencies in spotifys data where A has a connection to B but B doesnt have one back even though they should.
-            if not any(conn.id == ending_artist.id for conn in potential_end[1].connections): 
-                    potential_end[1].connections.append(ending_artist)  
-            #
-            await send_route_update(ws_connection, graph_manager, f"Connections for {potential_end[1].name} added", potential_end[1], 1, send_full_graph=send_full_graph)
-        print(f"potential_end is not empty. answer should be found")
-        # line below is erroring because the chosen_artist in this case is not 
-        for artist in potential_end:
-            artist_route.append(artist)
-            print(f"added {artist.name} to artist_route. -> [{', '.join([artist.name for artist in artist_route])}]")
-        found = True
-    
-    while not found: 
-        
-        #1. sort unchecked_artists.
-        unchecked_artists = sort_by_weight(unchecked_artists, ending_artist)
-        #2. remove last artist from the list and get their connections. 
-        artist_with_connections_found = False
-        while not artist_with_connections_found:
-            if len(unchecked_artists) == 0:
-                found = True
-                artist_route = []
-                break  # To exit the while loop if unchecked_artists is empty
-            chosen_artist : Tuple[Artist, int, int, List[Artist]] = unchecked_artists.pop(-1)
-            print(f"chosen_artist = {chosen_artist[0].name}. Depth: {chosen_artist[1]}. Weight: {chosen_artist[2]}. Previous_connections = [{', '.join([artist.name for artist in chosen_artist[3]])}]")
+    await send_route_update(ws_connection, graph_manager, f"Starting route finding: {starting_artist.name} -> {ending_artist.name}", starting_artist, 0, overrideUpdateType="start", send_full_graph=send_full_graph)
+
+    def out_of_budget() -> bool:
+        if budget is not None and not budget.spend_expansion():
+            print(f"Search budget ({budget.exhausted_reason}) used up, giving up on {starting_artist.name} -> {ending_artist.name}")
+            return True
+        return False
+
+    async def within_budget(expansion: Awaitable[List[List[ArtistRecord]]]) -> List[List[ArtistRecord]]:
+        # stops an expansion (e.g a huge crawl) that runs past the budget's deadline, is_exhausted() picks it up after
+        remaining_seconds = budget.remaining_seconds() if budget is not None else None
+        if remaining_seconds is None:
+            return await expansion
+        try:
+            return await asyncio.wait_for(expansion, remaining_seconds)
+        except asyncio.TimeoutError:
+            return []
+
+    budget_token = spotify_call_budget.set(budget) if budget is not None else None
+    try:
+        # 1. Get all related artists for both ends.
+        search_done = out_of_budget() or routes_proven(await within_budget(expand(forward_side, starting_artist, 0)))
+        if not search_done:
+            await set_selected_artist(ws_connection, ending_artist, graph_manager=graph_manager)
+            search_done = out_of_budget() or routes_proven(await within_budget(expand(backward_side, ending_artist, 0)))
+
+        # 2. Keep expanding whichever side is cheaper until they meet (route_count times) or both run dry.
+        while not search_done:
+            side = choose_side()
+            if side is None or out_of_budget():
+                break
+            chosen_record, weight = side.pop_best()
+            print(f"chosen_artist = {chosen_record.name} ({'forward' if side.is_forward else 'backward'}). Depth: {chosen_record.depth}. Weight: {weight}")
+            # start on the likely next picks while this one is being crawled
+            next_side = choose_side()
+            if prefetch_count > 0 and next_side is not None:
+                prefetcher.prefetch(next_side.frontier.peek(prefetch_count))
+            chosen_artist = chosen_record.to_artist()
             if (not send_full_graph):
-                await set_selected_artist(ws_connection, chosen_artist[0], graph_manager=graph_manager)
-            chosen_artist[0].connections = await get_connections(chosen_artist[0], db, ws_connection=ws_connection) # chosen_artist needs to be saved to database seen as it has its connections.
-            chosen_artist[0].lastUpdated = datetime.now(pytz.utc)
-            if chosen_artist[0].connections is not None:
-                artist_with_connections_found = True
-            else:
-                if len(unchecked_artists) == 0:
-                    found=True
-                    artist_route = []
-                    
-        if found:
-            break
-        await send_route_update(ws_connection, graph_manager, f"Connections for {chosen_artist[0].name} added", chosen_artist[0], chosen_artist[1], send_full_graph=send_full_graph)
+                await set_selected_artist(ws_connection, chosen_artist, graph_manager=graph_manager)
+            search_done = routes_proven(await within_budget(expand(side, chosen_artist, chosen_record.depth)))
+        if not search_done and (forward_side.has_frontier() or backward_side.has_frontier()):
+            alternatives_proven = False  # stopped by the budget, not because nothing else was left to find
+    finally:
+        prefetcher.cancel_all()  # route found (or search abandoned), the rest arent needed
+        if budget_token is not None:
+            spotify_call_budget.reset(budget_token)
+
+    if not found_routes and budget is not None and budget.is_exhausted():
+        closest_side = forward_side if forward_side.has_frontier() else backward_side
+        closest_records = closest_side.frontier.peek(1)
+        best_effort = BestEffortResult(
+            reason=budget.exhausted_reason,
+            closest_artist=closest_records[0].to_artist() if closest_records else None,
+            depth_reached=forward_side.depth_reached + backward_side.depth_reached,
+            budget_used=budget.usage()
+        )
+        await send_status_update(ws_connection, f"Search limit ({best_effort.reason}) reached before a route was found: {starting_artist.name} -> {ending_artist.name}")
+        return RouteReply(route_list=[], graph=graph_manager.get_graph() if send_full_graph else None, best_effort=best_effort)
+
+    # rebuilt once at the end, the two end points keep the artist objects that were passed in
+    ranked_routes = rank_routes(list(found_routes.values()))[:route_count]
+    artist_routes = [[starting_artist if record.id == starting_artist.id else ending_artist if record.id == ending_artist.id else record.to_artist()
+                      for record in route_records] for route_records in ranked_routes]
+    route_list = artist_routes[0] if artist_routes else []
+    print(f"route = [{', '.join([artist.name for artist in route_list])}]")
+    # popularity of -1 means artist has been skipped (had direct connection to target_artist)
+    missing_info = [artist for artist_route in artist_routes for artist in artist_route if artist.popularity == -1]
+    if missing_info:
+        await get_multiple_artists(missing_info)
         if db:
-            save_artist(db, chosen_artist[0])
-        potential_end = check_if_complete(chosen_artist[0], checked_artists, ending_artist)
-        if potential_end != []:
-            # to check if target_artist or connecting artist is used
-            required_connecting_artist = len(potential_end) > 2
-            if required_connecting_artist:
-                potential_end[1].connections = await get_connections(potential_end[1], db, ws_connection=ws_connection)
-                # Fixes inconsistencies in spotifys data where A has a connection to B but B doesnt have one back even though they should.
-                if not any(connection.id == ending_artist.id for connection in potential_end[1].connections): 
-                    potential_end[1].connections.append(ending_artist)  
-                #
-                await send_route_update(ws_connection, graph_manager, f"Connections for {potential_end[1].name} added", potential_end[1], chosen_artist[1] + 1, send_full_graph=send_full_graph)
-            print(f"potential_end is not empty. answer should be found")
-            for artist in chosen_artist[3]:
-                artist_route.append(artist)
-                print(f"added {artist.name} to artist_route. -> [{', '.join([artist.name for artist in artist_route])}]")
-            for artist in potential_end:
-                artist_route.append(artist)
-                print(f"added {artist.name} to artist_route. -> [{', '.join([artist.name for artist in artist_route])}]")
-            found = True
-        else:
-            #3. add their connections to unchecked_artists (with their associated depth being the artist just removed + 1.) 
-            # Assuming checked_artists is a list of tuples [Artist, Bool]
-            checked_artist_ids = {artist.id for artist, _ in checked_artists}
-            unchecked_artists_ids = {artist.id for artist, _, _, _ in unchecked_artists}
-            new_previous_connections = []
-            for connection in chosen_artist[3]:
-                new_previous_connections.append(connection)
-            new_previous_connections.append(chosen_artist[0])    
-            # print(f"{new_previous_connections}")
-            for connection in chosen_artist[0].connections:
-                if connection.id not in checked_artist_ids and connection.id not in unchecked_artists_ids:
-                    unchecked_artists.append((connection, chosen_artist[1] + 1, -1, new_previous_connections)) #if errors try chosen_artist[3].append(chosen_artist[0])
-                    # print(f"Added ({connection.name}, {chosen_artist[1] + 1}, -1, {",".join(artist.name for artist in new_previous_connections)})")
-    
-    need_info = False
-    for artist in artist_route:
-        if artist.popularity == -1:
-            # means artist has been skipped (had direct connection to target_artist)
-            need_info = True       
-    if need_info:
-        artist_route = await get_multiple_artists(artist_route)
-        print(f"{artist_route}")
-
-    save_multiple_artists(db, artist_route) 
-    route_list = artist_route[::-1] if flipped_artists else artist_route
+            # only these need saving, everything else on the route was saved when it (or its neighbour) was expanded
+            await db.save_multiple_artists(list({artist.id: artist for artist in missing_info}.values()))
     graph_manager.finalise_graph(ending_artist, route_list)
     route_reply = RouteReply(
         route_list=route_list,
-        graph=graph_manager.get_graph() if send_full_graph else None
+        graph=graph_manager.get_graph() if send_full_graph else None,
+        alternative_routes=artist_routes[1:],
+        alternatives_proven=alternatives_proven
     ) 
        
     return route_reply       
+
+class BatchRouteResult(BaseModel):
+    starting_artist_id: str
+    ending_artist_id: str
+    route_list: List[Artist]  # empty if no route was found (or the batch's budget ran out first)
+    degrees: Optional[int] = None  # collaborations between the two, len(route_list) - 1
+    error: Optional[str] = None
+    best_effort: Optional[BestEffortResult] = None  # set when the batch's budget ran out before this pair's route was found
+
+async def find_routes_batch(pairs: List[Tuple[Artist, Artist]], db: AsyncDb = None, crawl_policy: CrawlPolicy = None, use_cached_graph=True,
+                            budget: SearchBudget = None, concurrency: int = None) -> Tuple[List[BatchRouteResult], int]:
+    # Runs many searches together (no websocket, no graphs). They share one connection cache, so an artist expanded for
+    # one pair is reused by the others, and one budget so a batch cant run away with the rate limit. Their spotify calls
+    # queue behind interactive searches.
+    # Returns the results (in the order of pairs) and the number of expansions used.
+    connection_cache: Dict[str, List[Artist]] = {}
+    budget = budget or SearchBudget()
+    semaphore = asyncio.Semaphore(max(1, concurrency or settings.batch_route_concurrency or len(pairs)))  # 0 / None = every pair at once
+    priority = CallPriority(BATCH_PRIORITY)
+
+    async def find_pair(starting_artist: Artist, ending_artist: Artist) -> BatchRouteResult:
+        spotify_call_priority.set(priority)  # only affects this pair's task, gather runs each in its own
+        async with semaphore:
+            try:
+                route_reply = None
+                if use_cached_graph:
+                    route_reply = await find_recent_route(starting_artist, ending_artist, send_full_graph=False) \
+                        or await find_cached_route(starting_artist, ending_artist, send_full_graph=False)
+                if route_reply is None:
+                    route_reply = await find_route(starting_artist, ending_artist, None, db, send_full_graph=False, crawl_policy=crawl_policy,
+                                                   connection_cache=connection_cache, budget=budget)
+                    if route_reply.route_list:
+                        remember_route(route_reply)
+            except Exception as e:
+                print(f"Batch route {starting_artist.name} -> {ending_artist.name} failed: {e}")
+                return BatchRouteResult(starting_artist_id=starting_artist.id, ending_artist_id=ending_artist.id, route_list=[], error=str(e))
+            route_list = remove_connections([artist.model_copy() for artist in route_reply.route_list])
+            return BatchRouteResult(starting_artist_id=starting_artist.id, ending_artist_id=ending_artist.id, route_list=route_list,
+                                    degrees=len(route_list) - 1 if route_list else None, best_effort=route_reply.best_effort)
+
+    results = await asyncio.gather(*[find_pair(starting_artist, ending_artist) for starting_artist, ending_artist in pairs])
+    return list(results), budget.expansions
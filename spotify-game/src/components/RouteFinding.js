@@ -187,7 +187,7 @@ const RouteFinding = () => {
         if (!hasWsConnection) {
             // console.log("Running websocket connection attempt");
 
-            const id = generateWebSocketId();
+            const id = getWebSocketId();
             setWsId(id);
             // console.log("creating websocket with id: " + id);
             const newSocket = createWebSocket(id);
@@ -374,7 +374,7 @@ const RouteFinding = () => {
             // console.log('WebSocket connection closed, attempting to reconnect');
             setHasWsConnection(false);
             clearInterval(pingInterval);
-            const newId = generateWebSocketId();
+            const newId = getWebSocketId();
             setWsId(newId);
             const newSocket = createWebSocket(newId);
             setWs(newSocket);
@@ -382,6 +382,16 @@ const RouteFinding = () => {
         return socket;
     };
 
+    // One id for the whole page session, reconnecting under the same id lets the server carry on a route search
+    // that was running when the connection dropped (and send its updates to the new socket)
+    const wsIdRef = useRef(null);
+    const getWebSocketId = () => {
+        if (!wsIdRef.current) {
+            wsIdRef.current = generateWebSocketId();
+        }
+        return wsIdRef.current;
+    };
+
     const generateWebSocketId = (length = 8) => {
         const base62Characters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789';
         let wsId = '';
@@ -437,8 +447,18 @@ const RouteFinding = () => {
                     // console.log('Route:', response.data.route_list);
                     // console.log("Final Graph: ");
                     // console.log(response.data.graph)
-                    setDisplayMessage('Route: ' + response.data.route_list.map(artist => artist.name).join(' -> '));
-                    setSecondaryMessage("");
+                    const bestEffort = response.data.best_effort;
+                    if (bestEffort) {
+                        // search ran out of its budget before finding a route, say so instead of showing an empty route
+                        const limitNames = { time: "time", expansions: "artists to search", api_calls: "Spotify requests" };
+                        setDisplayMessage("Search stopped before finding a route: ran out of " + (limitNames[bestEffort.reason] || bestEffort.reason) + ".");
+                        setSecondaryMessage(bestEffort.closest_artist
+                            ? "Got as far as " + bestEffort.closest_artist.name + " (" + bestEffort.depth_reached + " steps searched). Try again, or pick artists closer together."
+                            : "Try again, or pick artists closer together.");
+                    } else {
+                        setDisplayMessage('Route: ' + response.data.route_list.map(artist => artist.name).join(' -> '));
+                        setSecondaryMessage("");
+                    }
                     setProgressBarPercent(null);
                     setGraphData(prevGraphData => {
                         setPrevGraphData(prevGraphData)